@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Compare the memory footprint of the watcher's path sets against a plain
+dict of absolute paths, over a synthetic TV library.
+
+    python3 bench/pathset_memory.py [paths]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from watcher.pathset import PathSet
+
+ROOT = '/data/original/TV'
+
+
+def library(count):
+    """
+    Yield paths shaped like a Sonarr library, built fresh each time so
+    no strings are shared between the measured structures.
+    """
+    show = 0
+    while True:
+        name = "Show Title Number %05d (%d)" % (show, 1990 + show % 30)
+        for season in range(1, 9):
+            for episode in range(1, 25):
+                yield "%s/%s/Season %02d/%s - S%02dE%02d - Episode Title WEBDL-1080p.mkv" % (
+                        ROOT, name, season, name, season, episode)
+                count -= 1
+                if count == 0:
+                    return
+        show += 1
+
+
+def probes(count, samples=1000):
+    """
+    Paths spread evenly across the library, built fresh so lookups
+    compare strings rather than finding them by identity.
+    """
+    step = max(1, count // samples)
+    return list(islice(library(count), 0, None, step))
+
+
+def measure(build, count):
+    tracemalloc.start()
+    start = time.time()
+    structure = build(library(count))
+    elapsed = time.time() - start
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (structure, current, elapsed)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    builds = [
+        ('dict', lambda paths: {p: True for p in paths}),
+        ('PathSet', PathSet),
+    ]
+
+    print("%d paths" % count)
+    results = {}
+    for (name, build) in builds:
+        (structure, size, elapsed) = measure(build, count)
+        results[name] = size
+        paths = probes(count)
+        rounds = max(1, 100000 // len(paths))
+        start = time.time()
+        for _ in range(rounds):
+            for path in paths:
+                path in structure
+        lookup = (time.time() - start) * 1e6 / (rounds * len(paths))
+        print("%-8s %8.1f MB  %6.1f B/path  build %5.2fs  lookup %5.2fus" % (
+            name, size / 2**20, size / count, elapsed, lookup))
+        del structure
+
+    print("PathSet uses %.1f%% of the dict footprint" %
+            (100.0 * results['PathSet'] / results['dict']))
+
+
+if __name__ == '__main__':
+    main()
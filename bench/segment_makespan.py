@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compare the split makespan of fixed segment_time cuts against balanced
+keyframe cuts, over synthetic sources. Encode work is taken as
+proportional to segment duration, with a worker available per segment,
+so the makespan is the longest segment.
+
+    python3 bench/segment_makespan.py [sources]
+"""
+
+import os
+import sys
+import math
+import random
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'transcoder'))
+import segments
+
+# Defaults from TRANSCODER in config.py
+SEGMENT_MIN = 300
+SEGMENT_MAX = 1200
+SEGMENT_PARTS = 8
+
+
+def segment_length(duration):
+    """
+    Encoding.calculate_segment_length
+    """
+    secs = math.ceil(duration / SEGMENT_PARTS)
+    return min(SEGMENT_MAX, max(SEGMENT_MIN, secs))
+
+
+def keyframes(duration, gop):
+    """
+    Keyframes at a regular GOP with scene cut keyframes in between.
+    """
+    times = [0.0]
+    while times[-1] < duration:
+        step = gop if random.random() < 0.7 else random.uniform(0.2, gop)
+        times.append(times[-1] + step)
+    return times
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    random.seed(0)
+    reductions = []
+    totals = [0.0, 0.0]
+    for _ in range(count):
+        duration = random.uniform(20 * 60, 180 * 60)
+        frames = keyframes(duration, random.choice([2, 4, 5, 10]))
+        length = segment_length(duration)
+        parts = math.ceil(duration / length)
+
+        fixed = max(segments.segment_lengths(
+            segments.fixed_cuts(frames, duration, length), duration))
+        balanced = max(segments.segment_lengths(
+            segments.balanced_cuts(frames, duration, parts), duration))
+        totals[0] += fixed
+        totals[1] += balanced
+        reductions.append(100.0 * (fixed - balanced) / fixed)
+
+    print("%d sources, 20-180 minutes" % count)
+    print("mean makespan: fixed %.0fs, balanced %.0fs" % (
+        totals[0] / count, totals[1] / count))
+    print("makespan reduction: mean %.1f%%, median %.1f%%, max %.1f%%, min %.1f%%" % (
+        statistics.mean(reductions), statistics.median(reductions),
+        max(reductions), min(reductions)))
+
+
+if __name__ == '__main__':
+    main()
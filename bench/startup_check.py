@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Construct the watcher and transcoder from the default configuration,
+with state kept in a temporary directory, and check their HTTP routes
+answer. Exits non-zero if the controller could not start.
+
+    python3 bench/startup_check.py
+"""
+
+import os
+import sys
+import copy
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import config
+import metrics
+import tracing
+from watcher import Watcher
+from transcoder import Transcoder
+
+
+class Pending:
+    """
+    Stand-in for the scheduler's pending queue.
+    """
+
+    def enqueue(self, job):
+        pass
+
+
+def relocate(node, state):
+    """
+    Point every state path of a configuration into the state directory.
+    """
+    for (key, value) in node.items():
+        if isinstance(value, dict):
+            relocate(value, state)
+        elif key.endswith('Path') or key == 'path':
+            if value:
+                node[key] = os.path.join(state, os.path.basename(value))
+
+
+def main():
+    state = tempfile.mkdtemp()
+    settings = copy.deepcopy(config.DEFAULT_CONFIG)
+    relocate(settings, state)
+
+    watcher = Watcher(settings['watcher'])
+    transcoder = Transcoder(watcher.new, watcher.finished, Pending(), None,
+            settings['transcoder'], settings['scheduler']['maxWorkers'])
+    watcher.routes.update(transcoder.routes())
+    watcher.routes.update(tracing.routes())
+
+    for (path, route) in sorted(watcher.routes.items()):
+        route({'source': ''} if path == '/trace' else {})
+        print("Route %s ok" % path)
+    assert "replicant_plans_active" in metrics.render()
+    print("Startup ok: %d encodings" % len(transcoder.encodings))
+
+
+if __name__ == '__main__':
+    main()
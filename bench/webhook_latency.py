@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Measure the time from a webhook POST to the resulting job being
+enqueued, through the watcher and transcoder threads. Planning itself and
+the request coalescing window are skipped, so the figure is the
+controller's handoff latency.
+
+    python3 bench/webhook_latency.py [requests]
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import tempfile
+import statistics
+import urllib.request
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import config
+from startup_check import relocate
+from watcher import Watcher
+from transcoder import Transcoder
+
+
+class Enqueued:
+    """
+    Stand-in for the scheduler's pending queue, recording arrivals.
+    """
+
+    def __init__(self):
+        self.times = Queue()
+
+    def enqueue(self, source):
+        self.times.put((source, time.time()))
+
+
+class Handoff(Transcoder):
+    """
+    Transcoder that enqueues each source without planning it.
+    """
+
+    def add_plan(self, source):
+        self.add_jobs.enqueue(source)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    state = tempfile.mkdtemp()
+    root = tempfile.mkdtemp()
+
+    watcher_config = copy.deepcopy(config.WATCHER)
+    relocate(watcher_config, state)
+    watcher_config.update(root=root, port=free_port(), notify=False, coalesceDelay=0,
+            indexPath='')
+    transcoder_config = copy.deepcopy(config.TRANSCODER)
+    relocate(transcoder_config, state)
+
+    jobs = Enqueued()
+    watcher = Watcher(watcher_config)
+    transcoder = Handoff(watcher.new, watcher.finished, jobs, None, transcoder_config)
+    watcher.start()
+    transcoder.start()
+    time.sleep(1)
+
+    url = 'http://127.0.0.1:%d/' % watcher_config['port']
+    latencies = []
+    try:
+        for i in range(count):
+            directory = os.path.join(root, 'Show %d' % i)
+            os.makedirs(directory)
+            open(os.path.join(directory, 'episode.mkv'), 'w').close()
+
+            body = json.dumps({'path': directory}).encode()
+            start = time.time()
+            urllib.request.urlopen(urllib.request.Request(url, data=body)).read()
+            (source, end) = jobs.times.get(timeout=30)
+            latencies.append(end - start)
+            watcher.finished.put(source)
+    finally:
+        watcher.shutdown()
+        transcoder.shutdown()
+        watcher.join()
+        transcoder.join()
+
+    latencies = sorted(l * 1000 for l in latencies)
+    print("%d webhooks: p50 %.1f ms, p95 %.1f ms, max %.1f ms" % (
+        count, statistics.median(latencies),
+        latencies[int(0.95 * (len(latencies) - 1))], latencies[-1]))
+
+
+if __name__ == '__main__':
+    main()
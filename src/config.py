@@ -4,11 +4,32 @@ NOTIFICATIONS = { }
 
 WATCHER = {
         'loopDelay': 1200,
+        # inotify is refused on FUSE mounts, such as rclone's, which then
+        # fall back to walking every loopDelay. The long reconcileDelay
+        # only applies to roots where notifications are active.
+        'notify': True,
+        'notifySettle': 10,
+        'reconcileDelay': 21600,
         'backupPath': '/state/finished.gz',
+        'journalPath': '/state/finished.journal',
+        'compactSize': 10000,
+        'indexPath': '/state/index.db',
         'root': '/data/original',
         'port': 9234,
+        'intakeSize': 100,
+        'coalesceDelay': 5,
         'maxQueued': 10,
-        'ignore': '.*\.srt$'
+        'ignore': '.*\.srt$',
+        'filters': {
+            'include': [],
+            'exclude': ['*.partial', '*.part', '*.!qB', '*-sample.*'],
+            'excludeDirs': ['Extras', 'Featurettes', 'Sample', 'Samples',
+                '*.partial', '.*'],
+            'extensions': ['mkv', 'mp4', 'm4v', 'avi', 'mov', 'wmv', 'ts',
+                'm2ts', 'mpg', 'mpeg', 'webm', 'flv'],
+            'minSize': 0,
+            'minAge': 0
+            }
         }
 
 SCHEDULER = {
@@ -26,19 +47,69 @@ CLOUD = {
             }
         }
 
+TRACING = {
+        'path': '/state/traces.jsonl',
+        'maxBytes': 64 * 1024 * 1024,
+        'maxTraces': 10000
+        }
+
 TRANSCODER = {
         'src': '/data/original',
         'dst': '/data/optimised',
         'encodings': ['720p', '1080p'],
+        'planWorkers': 4,
+        'workflow': 'auto',
+        'workflowPaths': {},
+        'rangeMinDuration': 1800,
         'segmentMin': 300,
         'segmentMax': 1200,
         'segmentParts': 8,
+        'probeCache': {
+            'path': '/state/probe.db',
+            'maxEntries': 50000
+            },
+        'verification': {
+            'workers': 4,
+            'timeout': 120,
+            'delay': 5,
+            'maxDelay': 30,
+            'attempts': 3
+            },
+        'validationCache': {
+            'path': '/state/validation.db',
+            'maxEntries': 100000
+            },
+        'planState': {
+            'path': '/state/plans.db'
+            },
+        'throughput': {
+            'path': '/state/throughput.db',
+            'samples': 200,
+            'minSamples': 5,
+            'targetWall': 900,
+            'scale': 600,
+            'agingWindow': 3600
+            },
+        'history': {
+            'path': '/state/history.db',
+            'retention': 90
+            },
+        'speculation': {
+            'enabled': True,
+            'interval': 60,
+            'factor': 1.5,
+            'minDone': 0.5
+            },
         'job': {
             'pattern': 'output%03d.original',
             'tmpDir': 'remote:/transcoding',
             'mountLocal': '/data',
             'mountRemote': 'remote:',
             'rcloneArgs': '--config /opt/rclone.conf',
+            'splitMode': 'download',
+            'streamAddr': '127.0.0.1:8181',
+            'streamSegments': 3,
+            'cancelPoll': 60,
             'maxAttempts': 3
             }
         }
@@ -49,7 +120,8 @@ DEFAULT_CONFIG = {
         'scheduler': SCHEDULER,
         'notifications': NOTIFICATIONS,
         'cloud': CLOUD,
-        'transcoder': TRANSCODER
+        'transcoder': TRANSCODER,
+        'tracing': TRACING
         }
 
 def merge(source, destination):
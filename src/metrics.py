@@ -0,0 +1,140 @@
+"""
+Counters, gauges and summaries for the pipeline, exported in the
+Prometheus text format from the watcher's HTTP server.
+Modules declare their metrics at import, as they do their loggers.
+"""
+
+import math
+from threading import Lock
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, escape(v)) for (k, v) in labels) + "}"
+
+
+def format_value(value):
+    if value is None or math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric, holding a value per set of labels.
+    Values may also be read on demand from a callback, for state kept
+    elsewhere such as queue depths.
+    """
+
+    def __init__(self, kind, name, help):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self.values = {}
+        self.callbacks = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def track(self, fn, **labels):
+        """
+        Read the value for these labels from fn on each export.
+        """
+        with self.lock:
+            self.callbacks[self.key(labels)] = fn
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            callbacks = dict(self.callbacks)
+        for (key, fn) in callbacks.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                values[key] = None
+        return [(self.name, key, value) for (key, value) in sorted(values.items())]
+
+
+class Summary(Metric):
+    """
+    Count and total of observations, such as durations in seconds.
+    """
+
+    def __init__(self, name, help):
+        super().__init__('summary', name, help)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            (count, total) = self.values.get(key, (0, 0.0))
+            self.values[key] = (count + 1, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        result = []
+        for (key, (count, total)) in values:
+            result.append((self.name + "_count", key, count))
+            result.append((self.name + "_sum", key, total))
+        return result
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for (name, labels, value) in metric.samples():
+                lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help):
+    return REGISTRY.register(Metric('counter', name, help))
+
+
+def gauge(name, help):
+    return REGISTRY.register(Metric('gauge', name, help))
+
+
+def summary(name, help):
+    return REGISTRY.register(Summary(name, help))
+
+
+def render():
+    return REGISTRY.render()
@@ -7,6 +7,11 @@ from email.mime.multipart import MIMEMultipart
 
 from plexapi.myplex import MyPlexAccount
 
+import metrics
+
+NOTIFY_SECONDS = metrics.summary("replicant_notification_seconds",
+        "Time spent sending notifications, by channel and outcome.")
+
 ExceptionTemplate = string.Template(
 """Server encountered an exception during execution:
   Message: $msg
@@ -28,6 +33,15 @@ class Notifications:
         self.plex = config['plex']
 
     def __send__(self, subject, body):
+        start = time.time()
+        try:
+            self.__send_email__(subject, body)
+        except Exception:
+            NOTIFY_SECONDS.observe(time.time() - start, channel="email", result="failed")
+            raise
+        NOTIFY_SECONDS.observe(time.time() - start, channel="email", result="sent")
+
+    def __send_email__(self, subject, body):
         msg = MIMEMultipart()
         msg['From'] = self.email['from']
         msg['To'] = self.email['to']
@@ -56,8 +70,11 @@ class Notifications:
         self.send(subject, msg)
 
     def update_services(self, target):
+        start = time.time()
         try:
             plex_scan(self.plex)
+            NOTIFY_SECONDS.observe(time.time() - start, channel="plex", result="sent")
             return "Plex updated"
         except Exception as e:
+            NOTIFY_SECONDS.observe(time.time() - start, channel="plex", result="failed")
             return e.msg
@@ -5,7 +5,9 @@ import logging
 import signal
 import argparse
 import notifications
+import tracing
 import uuid
+from threading import Thread, Event
 
 from jackhammer import Scheduler
 from jackhammer.cloud import GCP
@@ -19,10 +21,14 @@ shutdown_flag = False
 def main(config):
     # Create threads
     uid = str(uuid.uuid4())
+    tracing.configure(config['tracing'])
     notifications = Notifications(config['notifications'])
     jackhammer = Scheduler(lambda: GCP(uid, config['cloud']), config['scheduler'])
     watcher = Watcher(config['watcher'])
-    transcoder = Transcoder(watcher.new, watcher.finished, jackhammer.pending, notifications, config['transcoder'])
+    transcoder = Transcoder(watcher.new, watcher.finished, jackhammer.pending, notifications,
+            config['transcoder'], config['scheduler']['maxWorkers'])
+    watcher.routes.update(transcoder.routes())
+    watcher.routes.update(tracing.routes())
     threads = [jackhammer, watcher, transcoder]
 
     # Setup the signal handler for shutdown
@@ -34,11 +40,16 @@ def main(config):
     signal.signal(signal.SIGTERM, lambda s, f: shutdown())
     signal.signal(signal.SIGINT, lambda s, f: shutdown())
 
-    # Launch and join
+    # Launch, stopping every thread once any of them exits
+    stopped = Event()
+    def monitor(thread):
+        thread.join()
+        stopped.set()
     [t.start() for t in threads]
-    while True in [t.is_alive() for t in threads]:
-        [t.join(timeout=1) for t in threads]
-        [shutdown() for t in threads if not t.is_alive()]
+    [Thread(target=monitor, args=(t,), daemon=True).start() for t in threads]
+    stopped.wait()
+    shutdown()
+    [t.join() for t in threads]
 
     # Manage any exceptions
     exception = None
@@ -0,0 +1,199 @@
+"""
+End-to-end traces of source files, from discovery to published output.
+A trace is started when the watcher queues a source, and each step
+taken for it, on the controller or on a worker, is written as a span to
+a JSON lines file. Spans are found by source, as the path is carried
+through the queues, plans and jobs.
+"""
+
+import os
+import json
+import time
+import logging
+from uuid import uuid4
+from threading import Lock
+from collections import OrderedDict
+
+logger = logging.getLogger("replicant.tracing")
+
+# Spans ending this close to the start of the next are taken to lead
+# into it when following the critical path.
+SLACK = 1.0
+
+
+class Trace:
+
+    def __init__(self, tracer, source, start):
+        self.tracer = tracer
+        self.id = uuid4().hex[:16]
+        self.source = source
+        self.start = start
+        self.queued = time.time()
+
+    def span(self, name, start, end=None, **attrs):
+        """
+        Record a step of the trace, ending now unless given.
+        """
+        end = time.time() if end is None else end
+        self.tracer.write({'trace': self.id, 'source': self.source, 'span': name,
+            'start': start, 'end': end, 'duration': end - start, 'attrs': attrs})
+
+
+class Tracer:
+    """
+    Current trace of each recently queued source, and the span log.
+    Spans are dropped when no path is configured. The log is rotated
+    to a single backup once it exceeds its size limit.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.path = None
+        self.max_bytes = 0
+        self.max_traces = 10000
+        self.traces = OrderedDict()
+
+    def configure(self, config):
+        self.path = config['path']
+        self.max_bytes = config['maxBytes']
+        self.max_traces = config['maxTraces']
+
+    def start(self, source, start=None):
+        """
+        Begin a new trace of a source, replacing any earlier one.
+        """
+        trace = Trace(self, source, time.time() if start is None else start)
+        with self.lock:
+            self.traces.pop(source, None)
+            self.traces[source] = trace
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        return trace
+
+    def get(self, source):
+        """
+        The current trace of a source, starting one if there is none.
+        """
+        with self.lock:
+            trace = self.traces.get(source)
+        return trace or self.start(source)
+
+    def write(self, record):
+        if not self.path:
+            return
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            try:
+                if self.max_bytes and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+            except OSError:
+                pass
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            except OSError as e:
+                logger.warning("Failed to write span: %s", str(e))
+
+    def scan(self, key, value):
+        """
+        Spans of the log with a field of the given value. Lines are
+        matched on the field's encoding before being parsed, so only
+        the spans wanted are decoded.
+        """
+        needle = '"%s": %s' % (key, json.dumps(value))
+        spans = []
+        for path in (self.path + ".1", self.path) if self.path else ():
+            try:
+                with open(path, 'r') as f:
+                    for line in f:
+                        if needle not in line:
+                            continue
+                        try:
+                            span = json.loads(line)
+                        except ValueError:
+                            continue
+                        if span.get(key) == value:
+                            spans.append(span)
+            except OSError:
+                continue
+        return spans
+
+    def load(self, trace=None, source=None):
+        """
+        Spans of a trace, by id or as the latest trace of a source.
+        """
+        if trace is None:
+            spans = self.scan('source', source)
+            if not spans:
+                return []
+            trace = spans[-1]['trace']
+        else:
+            spans = self.scan('trace', trace)
+        return sorted((s for s in spans if s['trace'] == trace),
+                key=lambda s: (s['start'], s['end']))
+
+    def summary(self, query):
+        """
+        Spans and critical path of a trace, queried by id or source.
+        """
+        if 'id' not in query and 'source' not in query:
+            raise ValueError("Query requires an id or source")
+        spans = self.load(query.get('id'), query.get('source'))
+        if not spans:
+            return {}
+        start = min(s['start'] for s in spans)
+        end = max(s['end'] for s in spans)
+        return {'trace': spans[0]['trace'], 'source': spans[0]['source'],
+                'start': start, 'end': end, 'duration': end - start,
+                'spans': spans, 'criticalPath': critical_path(spans)}
+
+
+def critical_path(spans):
+    """
+    Chain of spans leading to the end of a trace, found by stepping back
+    from the last span to end to the latest one ending before it began.
+    Gaps between steps are reported as waits.
+    """
+    remaining = sorted(spans, key=lambda s: s['end'])
+    if not remaining:
+        return []
+    current = remaining.pop()
+    path = [current]
+    while True:
+        earlier = [s for s in remaining if s['end'] <= current['start'] + SLACK
+                and s['start'] < current['start']]
+        if not earlier:
+            break
+        current = earlier[-1]
+        remaining = [s for s in remaining if s['end'] <= current['end'] and s is not current]
+        path.append(current)
+    path.reverse()
+    steps = []
+    for (i, span) in enumerate(path):
+        wait = span['start'] - path[i - 1]['end'] if i > 0 else 0.0
+        steps.append({'span': span['span'], 'start': span['start'],
+            'duration': span['duration'], 'wait': max(0.0, wait),
+            'attrs': span['attrs']})
+    return steps
+
+
+TRACER = Tracer()
+
+
+def configure(config):
+    TRACER.configure(config)
+
+
+def start(source, start=None):
+    return TRACER.start(source, start)
+
+
+def get(source):
+    return TRACER.get(source)
+
+
+def routes():
+    """
+    GET routes for the HTTP server, querying the span log.
+    """
+    return {'/trace': TRACER.summary}
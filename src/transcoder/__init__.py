@@ -1,16 +1,39 @@
-import time
 import traceback
 import logging
+import time
 import os
-from threading import Thread, Event
+from threading import Thread, Event, BoundedSemaphore, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
 from transcoder.encoding import LowBitRate, HighBitRate
 from transcoder.plan import Plan
+from transcoder.videoInfo import ProbeCache
+from transcoder.validation import ValidationCache
+from transcoder.verification import Verifier
+from transcoder.workload import Workload
+from transcoder.state import PlanStore
+from transcoder.speculation import Speculator
+from transcoder.throughput import ThroughputModel
+from transcoder.history import JobHistory
+from transcoder.jobs import timing
 
 logger = logging.getLogger("replicant.transcoder")
 
+PLANS = metrics.counter("replicant_plans_total",
+        "Plans created, by outcome of scheduling their jobs.")
+PLANS_ACTIVE = metrics.gauge("replicant_plans_active",
+        "Plans with jobs scheduled and not yet finished.")
+PLAN_COST = metrics.summary("replicant_plan_predicted_seconds",
+        "Worker time predicted for the conversions of new plans, by workflow.")
+PENDING_CONVERTS = metrics.gauge("replicant_pending_converts",
+        "Convert jobs planned or scheduled but not yet finished.")
+
 class Transcoder(Thread):
 
-    def __init__(self, incoming_files, finished_files, add_jobs, noti, config):
+    def __init__(self, incoming_files, finished_files, add_jobs, noti, config,
+            max_workers=None):
         super().__init__()
         self.name = "replicant.transcoder"
         self.exception = None
@@ -22,70 +45,189 @@ class Transcoder(Thread):
         self.finished_files = finished_files
         self.add_jobs = add_jobs
         self.config = config
+        self.slots = BoundedSemaphore(config['planWorkers'])
+        self.pool = None
+        self.cache = None
+        if config['probeCache']['path']:
+            self.cache = ProbeCache(config['probeCache'])
+        self.verdicts = None
+        if config['validationCache']['path']:
+            self.verdicts = ValidationCache(config['validationCache'])
+        self.verifier = Verifier(noti, config['verification'])
+        self.model = None
+        if config['throughput']['path']:
+            self.model = ThroughputModel(config['throughput'])
+        self.history = None
+        if config['history']['path']:
+            self.history = JobHistory(config['history'])
+        self.store = None
+        if config['planState']['path']:
+            self.store = PlanStore(config['planState'])
+        self.active = set()
+        self.active_lock = Lock()
+        PLANS_ACTIVE.track(lambda: len(self.active))
+        self.workload = None
+        if max_workers:
+            self.workload = Workload(max_workers)
+            PENDING_CONVERTS.track(lambda: self.workload.pending)
+        self.speculator = None
+        if config['speculation']['enabled']:
+            self.speculator = Speculator(add_jobs.enqueue, self.workload,
+                    config['speculation'])
         self.encodings = []
         if "720p" in config['encodings']:
-            self.encodings.append(lambda s, t, i, f: LowBitRate(s,t,i,f,noti,config))
+            self.encodings.append(self.encoding(LowBitRate))
         if "1080p" in config['encodings']:
-            self.encodings.append(lambda s, t, i, f: HighBitRate(s,t,i,f,noti,config))
+            self.encodings.append(self.encoding(HighBitRate))
+
+    def encoding(self, cls):
+        """
+        Returns a constructor for an encoding, bound to the transcoder's
+        services.
+        """
+        return lambda s, t, i, f: cls(s, t, i, f, self.notifications, self.config,
+                self.cache, self.verdicts, self.verifier, self.model, self.history)
+
+    def routes(self):
+        """
+        GET routes for the HTTP server, answering queries on the
+        transcoder's state.
+        """
+        return self.history.routes() if self.history else {}
 
     def shutdown(self):
         """
         Shutdown the transcoder.
         """
         self.shutdown_flag.set()
+        self.incoming_files.put(None)
 
     def run(self):
         """
         Thread entry point.
         """
         logger.info("Transcoder Launch: %s", self)
+        self.pool = ThreadPoolExecutor(max_workers=self.config['planWorkers'],
+                thread_name_prefix="replicant.plan")
+        if self.speculator:
+            self.speculator.start()
         try:
+            self.resume_plans()
             self.transcoder_loop()
         except Exception as e:
             logger.error("Transcoder Failure: %s", str(e))
             logger.error(traceback.format_exc())
             self.exception = e
 
+        # Let plans in progress finish scheduling
+        self.pool.shutdown(wait=True)
+        self.verifier.shutdown()
+        if self.speculator:
+            self.speculator.shutdown()
+
         logger.info("Transcoder Shutdown: %s", self)
 
+    def resume_plans(self):
+        """
+        Queue the sources of plans left in progress by a previous run,
+        ahead of the watcher rediscovering them.
+        """
+        if not self.store:
+            return
+        sources = self.store.sources()
+        if sources:
+            logger.info("Resuming %d stored plans", len(sources))
+        for source in sources:
+            tracing.start(source).span("resume", time.time())
+            self.incoming_files.put(source)
+
     def transcoder_loop(self):
         """
         Watch the incoming files queue, creating plans to transcode the
         result and launch corresponding jobs.
+        Plans are created on the pool, with files left on the queue while
+        every worker is busy. A None entry wakes the loop for shutdown.
         """
         while not self.shutdown_flag.is_set():
-            if not self.incoming_files.empty():
-                source = self.incoming_files.get()
-                self.add_plan(source)
-            else:
-                time.sleep(2)
+            self.slots.acquire()
+            source = self.incoming_files.get()
+            if source is None:
+                self.slots.release()
+                continue
+            self.pool.submit(self.run_plan, source)
+
+    def run_plan(self, source):
+        """
+        Pool entry point, releasing the worker slot once planned.
+        """
+        trace = tracing.get(source)
+        trace.span("queue", trace.queued)
+        try:
+            self.add_plan(source)
+        except Exception as e:
+            logger.error("Plan Failure: %s %s", source, str(e))
+            logger.error(traceback.format_exc())
+        finally:
+            self.slots.release()
 
     def add_plan(self, source):
         """
+        Plan the conversion of a source file and schedule its jobs.
+        Failures are reported and the source marked as finished, without
+        affecting other plans.
         """
         target = source.replace(self.config['src'], self.config['dst'], 1) 
         target = os.path.dirname(target)
 
+        # Sources resumed at startup are also found by the watcher
+        with self.active_lock:
+            if source in self.active:
+                logger.debug("Ignoring source with active plan: %s", source)
+                return
+            self.active.add(source)
+
+        start = time.time()
         try:
-            plan = Plan(source, target, self.encodings, self.finish_plan, self.config)
+            plan = Plan(source, target, self.encodings, self.finish_plan, self.config,
+                    self.cache, self.workload, self.store, self.speculator)
             jobs = plan.get_jobs()
+            tracing.get(source).span("plan", start, jobs=len(jobs),
+                    workflow=plan.workflow, predicted=plan.predicted)
+            if plan.predicted is not None:
+                PLAN_COST.observe(plan.predicted, workflow=plan.workflow)
             for job in jobs:
                 logger.info("Scheduling job: %s", job)
                 self.add_jobs.enqueue(job)
-            if len(jobs) == 0:
+            timing.enqueued(jobs)
+            PLANS.inc(result="scheduled" if plan.remaining_encodings else "empty")
+
+            # Plans with nothing to encode finish once scheduled, leaving
+            # any cleanup of a stored plan to run on its own
+            if not plan.remaining_encodings:
                 self.finish_plan(plan)
         except Exception as e:
+            PLANS.inc(result="failed")
             logger.error("Failed to add job: %s %s", source, str(e))
             logger.error(traceback.format_exc())
             self.notifications.send_exception(e)
-            self.finished_files.put(source)
+            self.release(source)
 
     def finish_plan(self, plan):
         """
         Callback for a plan, called when it is finished.
         """
         logger.info("Finishing trancoder plan: %s", plan)
-        self.finished_files.put(plan.source)
+        self.release(plan.source)
+
+    def release(self, source):
+        """
+        Forget a source's plan and mark the source as finished.
+        """
+        if self.store:
+            self.store.finish(source)
+        with self.active_lock:
+            self.active.discard(source)
+        self.finished_files.put(source)
 
     def __repr__(self):
         return self.name
@@ -1,21 +1,32 @@
 import os
 import math
-import logging
 import time
+import logging
+
+import tracing
 from transcoder.jobs.remux import Remux
-from transcoder.videoInfo import VideoInfo
+from transcoder.videoInfo import VideoInfo, file_key
+from transcoder.validation import mp4_layout
 from transcoder.templates import SuccessReport, FailureReport
 
 logger = logging.getLogger("replicant.transcoder")
 
 
 class Encoding:
-    def __init__(self, source, target, info, finished, notifications, config):
+    def __init__(self, source, target, info, finished, notifications, config,
+            cache=None, verdicts=None, verifier=None, model=None, history=None):
         # Args
         self.source = source
         self.info = info
         self.finished = finished
         self.notifications = notifications
+        self.cache = cache
+        self.verdicts = verdicts
+        self.verifier = verifier
+        self.model = model
+        self.history = history
+        self.created = time.time()
+        self.trace = tracing.get(source)
         self.lang = self.info.lang
 
         # Calculate the expected output
@@ -50,14 +61,60 @@ class Encoding:
     def validate(self, detailed=False):
         """
         Validates a file conforms to the encoding.
-        Returns a string describing the issue, otherwise returns None in
-        the successful case.
+        Returns a tuple of whether the file is valid and a string
+        describing the result. Verdicts for unchanged targets are reused,
+        unless a detailed report is requested.
         """
         if not os.path.isfile(self.target):
             return (False, "Target does not exist")
 
+        key = file_key(self.target)
+        if self.verdicts and not detailed:
+            verdict = self.verdicts.get(self.target, key, self.name)
+            if verdict:
+                return verdict
+
+        msg = self.precheck(key[0])
+        if msg and not detailed:
+            verdict = (False, msg)
+        else:
+            (verdict, info) = self.check(detailed)
+        if self.verdicts:
+            self.verdicts.put(self.target, key, self.name, verdict)
+
+        if detailed:
+            verdict = (verdict[0], verdict[1] + "\n" + info.report())
+        return verdict
+
+    def precheck(self, size):
+        """
+        Cheap checks of the target, run before probing it.
+        Returns a description of the first problem found, or None.
+        The bit rate bounds are loose, as the target's duration is only
+        known from the source.
+        """
+        duration = self.info.general().duration / 1000.0
+        if duration > 0:
+            bit_rate = size * 8 / duration
+            if bit_rate > self.bit_rate * 1.5:
+                return "Exceeds maximum bit rate"
+            if bit_rate < self.audio_bit_rate / 4:
+                return "Target too small for source duration"
+
+        layout = mp4_layout(self.target)
+        if layout is None:
+            return "Wrong media type"
+        if not layout:
+            return "Not web optimised"
+        return None
+
+    def check(self, detailed=False):
+        """
+        Probe the target and check it against the constraints.
+        Returns the verdict and the target's info.
+        """
         msg = ""
-        info = VideoInfo(self.target)
+        info = VideoInfo(self.target, cache=self.cache)
         for (constraint, desc) in self.constraints:
             if not constraint(info):
                 msg += desc + "\n"
@@ -74,10 +131,7 @@ class Encoding:
             else:
                 msg = "Durations differ by more than 10 seconds"
 
-        if detailed:
-            msg += "\n" + info.report()
-
-        return (out, msg)
+        return ((out, msg), info)
 
     def calculate_segment_length(self):
         secs = math.ceil(self.info.general().duration / (1000.0 * self.parts))
@@ -87,6 +141,13 @@ class Encoding:
             return self.seg_max
         return secs
 
+    def segment_count(self):
+        """
+        Number of segments to split the source into.
+        """
+        duration = self.info.general().duration / 1000.0
+        return max(1, math.ceil(duration / self.calculate_segment_length()))
+
     def transform_filename(self, source):
         """
         Transform a filename into the format desired by this encoding.
@@ -124,24 +185,26 @@ class Encoding:
 
     def get_split_args(self):
         """
-        FFMPEG arguments to split the file.
+        FFMPEG arguments to split the file, excluding the segment muxer
+        and its cut points.
+        """
+        return self.get_range_args() + " -reset_timestamps 1"
+
+    def get_range_args(self):
+        """
+        FFMPEG arguments to copy a time range of the file, excluding the
+        range itself.
         """
         args = ["-hide_banner",
                 "-nostdin",
                 "-map_metadata",
                 "-1",
-                "-reset_timestamps",
-                "1",
                 "-c",
                 "copy",
                 "-map",
                 "0:v:" + str(self.info.video().stream_identifier),
                 "-map",
-                "0:a:" + str(self.info.audio().stream_identifier),
-                "-segment_time",
-                str(self.calculate_segment_length()),
-                "-f",
-                "segment"]
+                "0:a:" + str(self.info.audio().stream_identifier)]
         return " ".join(args)
 
     def get_remux_args(self):
@@ -175,24 +238,78 @@ class Encoding:
                 "language=" + self.info.get_audio_lang()]
         return " ".join(args)
 
-    def get_args(self):
-        return self.args
+    def get_scale_filter(self):
+        """
+        FFMPEG filter scaling the video down to fit the encoding's
+        resolution, keeping its aspect ratio and even dimensions.
+        """
+        (width, height) = self.video_size
+        return ("scale=w='min(%d,iw)':h='min(%d,ih)':force_original_aspect_ratio=decrease,"
+                "scale=trunc(iw/2)*2:trunc(ih/2)*2" % (width, height))
+
+    def get_encode_args(self):
+        """
+        FFMPEG output arguments encoding a segment into this encoding,
+        excluding the mapping of its scaled video. Segments hold only
+        the source's main video and audio streams.
+        """
+        args = ["-map",
+                "0:a:0",
+                "-map_metadata",
+                "-1",
+                "-map_chapters",
+                "-1",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "veryfast",
+                "-profile:v",
+                "high",
+                "-level:v",
+                str(self.video_level),
+                "-pix_fmt",
+                "yuv420p",
+                "-b:v",
+                "%dk" % self.video_target,
+                "-maxrate",
+                "%dk" % (self.video_bit_rate / 1000),
+                "-bufsize",
+                "%dk" % (2 * self.video_bit_rate / 1000),
+                "-c:a",
+                "aac",
+                "-ac",
+                str(self.audio_channels),
+                "-b:a",
+                str(self.audio_bit_rate),
+                "-metadata:s:a:0",
+                "language=" + self.info.get_audio_lang(),
+                "-movflags",
+                "faststart"]
+        return " ".join(args)
 
     def success(self, job):
         """
-        Verify the produced file is valid and run the callback.
+        Run the callback and hand the produced file to the verifier.
         """
         self.finished(self)
+        if self.verifier:
+            self.verifier.submit(self, job)
+        else:
+            self.verify(job)
 
-        # Wait for the file to exist
-        start = time.time()
-        while (time.time() - start) < 120 and not os.path.isfile(self.target):
-            time.sleep(5)
-
+    def verify(self, job):
+        """
+        Verify the produced file is valid, updating services and sending
+        a notification with the result.
+        """
         # Verify the output is valid
+        start = time.time()
         (valid, report) = self.validate(detailed=True)
+        self.trace.span("validate", start, encoding=self.name, valid=valid)
         if valid:
+            start = time.time()
             service = self.notifications.update_services(self.target)
+            self.trace.span("scan", start, encoding=self.name)
             subject = "Successful Encoding: %s" % self
         else:
             service = "Bad encoding, not done"
@@ -205,8 +322,11 @@ class Encoding:
             encoding=self.name,
             encoding_report=report,
             job=job.report(),
-            service=service)
+            service=service,
+            trace=self.trace.id)
+        start = time.time()
         self.notifications.send(subject, msg)
+        self.trace.span("notify", start, encoding=self.name)
 
     def failure(self, job):
         """
@@ -219,14 +339,18 @@ class Encoding:
             source=self.source,
             target=self.target,
             encoding=self.name,
-            job=job.report())
+            job=job.report(),
+            trace=self.trace.id)
+        start = time.time()
         self.notifications.send(subject, msg)
+        self.trace.span("notify", start, encoding=self.name, failed=True)
 
     def __repr__(self):
         return os.path.basename(self.target)
 
 class LowBitRate(Encoding):
-    def __init__(self, source, target, info, finished, notifications, config):
+    def __init__(self, source, target, info, finished, notifications, config,
+            cache=None, verdicts=None, verifier=None, model=None, history=None):
         # Container properties
         self.name = "LOW-720p"
         self.extension = "mp4"
@@ -243,14 +367,17 @@ class LowBitRate(Encoding):
         self.video_bit_rate = self.bit_rate - self.bit_rate_buffer - self.audio_bit_rate
         self.video_bit_depth = 8
         self.video_resolution = 720 * 1280
+        self.video_size = (1280, 720)
+        self.video_target = 1750
         self.video_format = 'AVC'
         self.video_level = 4.2
 
-        self.args = '--target 720p=1750 --mp4 --quick --720p --abr --audio-width main=stereo -H ab=128'
-        super().__init__(source, target, info, finished, notifications, config)
+        super().__init__(source, target, info, finished, notifications, config,
+                cache, verdicts, verifier, model, history)
 
 class HighBitRate(Encoding):
-    def __init__(self, source, target, info, finished, notifications, config):
+    def __init__(self, source, target, info, finished, notifications, config,
+            cache=None, verdicts=None, verifier=None, model=None, history=None):
         # Container properties
         self.extension = 'mp4'
         self.bit_rate_buffer = 75000
@@ -260,10 +387,12 @@ class HighBitRate(Encoding):
             self.name = 'HIGH-1080p'
             self.bit_rate = 8000000
             self.video_resolution = 1080 * 1920
+            self.video_size = (1920, 1080)
         else:
             self.name = 'HIGH-720p'
             self.bit_rate = 4000000
             self.video_resolution = 720 * 1280
+            self.video_size = (1280, 720)
 
         # Audio properties
         self.audio_bit_rate = 320000
@@ -274,27 +403,10 @@ class HighBitRate(Encoding):
 
         # Video properties
         self.video_bit_rate = self.bit_rate - delta
+        self.video_target = int(self.video_bit_rate / 1000)
         self.video_bit_depth = 8
         self.video_format = 'AVC'
         self.video_level = 4.2
 
-        # Args to converter script
-        self.args = [
-                '--target',
-                '1080p=' + str(int((8000000 - delta)/1000)),
-                '--target',
-                '720p=' + str(int((4000000 - delta)/1000)),
-                '--mp4',
-                '--quick',
-                '--max-height',
-                '1080',
-                '--max-width',
-                '1920',
-                '--abr',
-                '--audio-width',
-                'main=stereo',
-                '-H',
-                'ab=' + str(int(self.audio_bit_rate/1000))]
-        self.args = " ".join(self.args)
-
-        super().__init__(source, target, info, finished, notifications, config)
+        super().__init__(source, target, info, finished, notifications, config,
+                cache, verdicts, verifier, model, history)
@@ -0,0 +1,152 @@
+import re
+import json
+import time
+import sqlite3
+import logging
+from threading import Lock
+
+from transcoder.throughput import encodings_key
+
+logger = logging.getLogger("replicant.transcoder")
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    encoding TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    bytes_in INTEGER NOT NULL,
+    bytes_out INTEGER NOT NULL,
+    stages TEXT NOT NULL,
+    worker TEXT,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+CREATE INDEX IF NOT EXISTS jobs_source ON jobs (source);
+"""
+
+WORKER = re.compile(r"^Worker (\S+)", re.MULTILINE)
+
+# Seconds between deletions of records past their retention
+PRUNE_INTERVAL = 3600
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class JobHistory:
+    """
+    Structured record of every finished job, with the aggregate queries
+    served over the watcher's HTTP server. Records older than the
+    retention period are pruned at most once per prune interval.
+    """
+
+    def __init__(self, config):
+        self.retention = config['retention'] * 86400
+        self.pruned = 0
+        self.lock = Lock()
+        self.db = sqlite3.connect(config['path'], check_same_thread=False)
+        self.db.executescript(HISTORY_SCHEMA)
+
+    def record(self, job, status, bytes_in, bytes_out):
+        match = WORKER.search(getattr(job, 'stdout', None) or "")
+        row = (job.kind, job.name, job.timed[0].source, encodings_key(job.timed),
+                job.attempts, bytes_in, bytes_out, json.dumps(job.stages),
+                match.group(1) if match else None, status, job.created,
+                job.started, time.time())
+        with self.lock:
+            self.db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            now = time.time()
+            if now - self.pruned >= PRUNE_INTERVAL:
+                self.db.execute("DELETE FROM jobs WHERE finished < ?",
+                        (now - self.retention,))
+                self.pruned = now
+            self.db.commit()
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def throughput(self, hours=24):
+        """
+        Jobs finished, their outcomes and bytes moved, per hour.
+        """
+        rows = self.query(
+                "SELECT CAST(finished / 3600 AS INTEGER) * 3600 AS hour, kind, "
+                "COUNT(*), SUM(status = 'success'), SUM(bytes_in), SUM(bytes_out) "
+                "FROM jobs WHERE finished >= ? GROUP BY hour, kind ORDER BY hour",
+                (time.time() - hours * 3600,))
+        return [{'hour': hour, 'kind': kind, 'jobs': jobs, 'succeeded': ok,
+            'bytesIn': bytes_in, 'bytesOut': bytes_out}
+            for (hour, kind, jobs, ok, bytes_in, bytes_out) in rows]
+
+    def latency(self, days=7):
+        """
+        Median and 95th percentile of queueing and running time, by kind
+        of job.
+        """
+        rows = self.query(
+                "SELECT kind, started - created, finished - started FROM jobs "
+                "WHERE finished >= ? AND started IS NOT NULL AND status = 'success'",
+                (time.time() - days * 86400,))
+        kinds = {}
+        for (kind, queued, run) in rows:
+            (waits, runs) = kinds.setdefault(kind, ([], []))
+            waits.append(queued)
+            runs.append(run)
+        result = {}
+        for (kind, (waits, runs)) in kinds.items():
+            (waits, runs) = (sorted(waits), sorted(runs))
+            result[kind] = {'jobs': len(runs),
+                    'queuedP50': percentile(waits, 0.5), 'queuedP95': percentile(waits, 0.95),
+                    'runP50': percentile(runs, 0.5), 'runP95': percentile(runs, 0.95)}
+        return result
+
+    def plans(self, limit=50):
+        """
+        Bytes transferred and worker time spent per source, most recent
+        first.
+        """
+        rows = self.query(
+                "SELECT source, COUNT(*), SUM(bytes_in), SUM(bytes_out), "
+                "SUM(finished - started), MIN(created), MAX(finished) FROM jobs "
+                "GROUP BY source ORDER BY MAX(finished) DESC LIMIT ?", (limit,))
+        return [{'source': source, 'jobs': jobs, 'bytesIn': bytes_in,
+            'bytesOut': bytes_out, 'workerSeconds': work, 'created': created,
+            'finished': finished}
+            for (source, jobs, bytes_in, bytes_out, work, created, finished) in rows]
+
+    def jobs(self, limit=100):
+        """
+        The most recently finished jobs.
+        """
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM jobs ORDER BY finished DESC LIMIT ?",
+                    (limit,))
+            names = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        jobs = [dict(zip(names, row)) for row in rows]
+        for job in jobs:
+            job['stages'] = json.loads(job['stages'])
+        return jobs
+
+    def routes(self):
+        """
+        GET routes for the HTTP server, taking the query parameters.
+        """
+        return {
+            '/history/throughput': lambda q: self.throughput(float(q.get('hours', 24))),
+            '/history/latency': lambda q: self.latency(float(q.get('days', 7))),
+            '/history/plans': lambda q: self.plans(int(q.get('limit', 50))),
+            '/history/jobs': lambda q: self.jobs(int(q.get('limit', 100))),
+        }
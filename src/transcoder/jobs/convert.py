@@ -1,55 +1,330 @@
 import os
 from string import Template
+from urllib.parse import quote
 from jackhammer import Job, JobState
 
+from transcoder.jobs.outputs import outputs_sh, uploaded, local_path, skip
+from transcoder.jobs import timing
+
 CONVERT_SH="""#!/bin/bash
 set -ex
+echo "Worker $$(hostname)"
+$STAGES
 
-export PATH="$$PATH:/opt/rclone/:/opt/video_transcoding/bin/"
+export PATH="$$PATH:/opt/rclone/"
 export LC_ALL=C.UTF-8
 export LANG=C.UTF-8
 
 rm -rf /tmp/jackhammer*
 mkdir -p "$WORK_DIR"
 rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
+$OUTPUTS
+if $UPLOADED
+then
+  echo "Outputs already uploaded"
+  exit 0
+fi
 
+stage_begin download
 rclone $RCLONE_ARGS copy "$RCLONE_SOURCE" "$WORK_DIR"
-transcode-video $FFMPEG_ARGS "$ORIGINAL_FILE" -o "$CONVERTED_FILE"
-rclone $RCLONE_ARGS copy "$CONVERTED_FILE" "$RCLONE_TARGET"
+stage_end download $$(size_of "$ORIGINAL_FILE")
+$ENCODE
+rm -rf "$WORK_DIR" """
+
+ENCODE_SH="""stage_begin encode
+ffmpeg -hide_banner -nostdin -i "$ORIGINAL_FILE" -filter_complex "$FILTER" $OUTPUT_ARGS &
+ENCODE_PID=$$!
+POLL=$$((SECONDS + $CANCEL_POLL))
+while kill -0 $$ENCODE_PID 2>/dev/null
+do
+  sleep 1
+  [ $$SECONDS -ge $$POLL ] || continue
+  POLL=$$((SECONDS + $CANCEL_POLL))
+  if $UPLOADED
+  then
+    pkill -P $$ENCODE_PID || true
+    kill $$ENCODE_PID || true
+    echo "Cancelled, converted by another attempt"
+    exit 0
+  fi
+done
+wait $$ENCODE_PID
+stage_end encode $$(size_of $CONVERTED_FILES)
+"""
+
+UPLOAD_SH="""if ! $UPLOADED
+then
+  stage_begin upload:$STAGE
+  upload_sized "$CONVERTED_FILE" "$RCLONE_TARGET" "$RCLONE_TARGET"
+  stage_end upload:$STAGE $$(size_of "$CONVERTED_FILE")
+fi
+"""
+
+RANGE_SH="""#!/bin/bash
+set -ex
+echo "Worker $$(hostname)"
+$STAGES
+
+export PATH="$$PATH:/opt/rclone/"
+export LC_ALL=C.UTF-8
+export LANG=C.UTF-8
+
+rm -rf /tmp/jackhammer*
+mkdir -p "$WORK_DIR"
+rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
+$OUTPUTS
+if $UPLOADED
+then
+  echo "Outputs already uploaded"
+  exit 0
+fi
+
+stage_begin probe
+rclone $RCLONE_ARGS serve http "$RCLONE_SOURCE_DIR" --read-only --addr "$SERVE_ADDR" &
+SERVE_PID=$$!
+trap "kill $$SERVE_PID" EXIT
+for i in $$(seq 30)
+do
+  curl -sf -r 0-0 -o /dev/null "$SOURCE_URL" && break
+  sleep 1
+done
+curl -sf -r 0-0 -o /dev/null "$SOURCE_URL"
+
+# First keyframe at or after a time, so neighbouring ranges meet exactly.
+# Prints nothing if there is none, and fails if the probe did, other
+# than by being cut off once the keyframe was found.
+keyframe() {
+  ffprobe -v error -select_streams v:$VIDEO_STREAM -read_intervals "$$1%" \\
+          -show_entries packet=pts_time,flags -of csv=p=0 "$SOURCE_URL" \\
+          | awk -F, -v t="$$1" '$$1 != "N/A" && $$2 ~ /K/ && $$1 >= t { print $$1; exit }'
+  local STATUS=$${PIPESTATUS[0]}
+  [ $$STATUS -eq 0 ] || [ $$STATUS -eq 141 ]
+}
 
+KF_START=0
+if [ "$START_TIME" != "0" ]
+then
+  KF_START=$$(keyframe $START_TIME)
+fi
+KF_END=""
+if [ -n "$END_TIME" ]
+then
+  KF_END=$$(keyframe $END_TIME)
+fi
+stage_end probe
+
+if [ -z "$$KF_START" ] || [ "$$KF_START" = "$$KF_END" ]
+then
+  echo "Empty range $START_TIME-$END_TIME"
+  rm -rf "$WORK_DIR"
+  exit 0
+fi
+
+stage_begin download
+RANGE_ARGS=""
+if [ -n "$$KF_END" ]
+then
+  RANGE_ARGS="-t $$(awk -v s="$$KF_START" -v e="$$KF_END" 'BEGIN { print e - s }')"
+fi
+ffmpeg -ss "$$KF_START" -i "$SOURCE_URL" $$RANGE_ARGS $FFMPEG_ARGS \\
+        -avoid_negative_ts make_zero "$ORIGINAL_FILE"
+stage_end download $$(size_of "$ORIGINAL_FILE")
+$ENCODE
 rm -rf "$WORK_DIR" """
 
-class Convert(Job):
+class Convert(timing.Timed, Job):
     """
-    Convert a media file to a quality.
+    Convert a media file to one or more qualities.
+    The file is downloaded once and decoded once by a single ffmpeg
+    pass, its video split and scaled into an output per quality.
 
     Args:
         source: rclone path to the source file.
-        encoding: Encoding object, describing the desired output.
+        encodings: Encoding objects, describing the desired outputs.
         config: General job configuration.
         prereqs: Prerequisits for this job.
+        workload: Workload to release on completion.
+        store: PlanStore to record completion in.
+        group: SegmentGroup the job is an attempt of a segment for.
+        duration: Duration of the source file, in seconds.
     """
 
-    def __init__(self, source, encoding, config, prereqs=[]):
+    def __init__(self, source, encodings, config, prereqs=[], workload=None,
+            store=None, group=None, duration=None):
         super().__init__(config, prereqs=prereqs)
         self.source = source
-        self.encoding = encoding
+        self.target_dir = os.path.dirname(source)
+        self.encodings = encodings
+        self.workload = workload
+        self.store = store
+        self.group = group
+        self.segment = None
         self.priority = 8
 
         # Determine various filenames
         source_file = os.path.basename(source)
-        target_file = encoding.transform_filename(source_file)
-
-        filename = os.path.basename(encoding.source)
+        filename = os.path.basename(encodings[0].source)
+        (encode, self.targets) = self.encode(source_file, self.target_dir)
 
         # Fill in the template
-        self.name = "convert:%s:%s" % (filename, target_file)
+        self.name = "convert:%s:%s" % (filename, ",".join(self.targets))
         self.script = Template(CONVERT_SH).substitute(
             WORK_DIR=self.work_dir,
             RCLONE_ARGS=self.config["rcloneArgs"],
-            FFMPEG_ARGS=encoding.get_args(),
             RCLONE_SOURCE=self.source,
-            RCLONE_TARGET=os.path.dirname(self.source),
+            RCLONE_TARGET=self.target_dir,
+            ORIGINAL_FILE=os.path.join(self.work_dir, source_file),
+            ENCODE=encode,
+            OUTPUTS=outputs_sh(config),
+            STAGES=timing.STAGES_SH,
+            UPLOADED=self.uploaded_sh(self.target_dir)
+        )
+        if duration is None:
+            duration = encodings[0].info.general().duration / 1000.0
+        timing.schedule(self, 'convert', encodings, duration)
+
+    def encode(self, source_file, target):
+        """
+        Script lines encoding every rendition of a local source file in
+        one pass and uploading each, along with the rendition filenames.
+        """
+        targets = [e.transform_filename(source_file) for e in self.encodings]
+        converted = [os.path.join(self.work_dir, t) for t in targets]
+        count = len(self.encodings)
+        graph = ["[0:v:0]split=%d%s" % (count, "".join("[s%d]" % i for i in range(count)))]
+        outputs = []
+        for (i, encoding) in enumerate(self.encodings):
+            graph.append("[s%d]%s[v%d]" % (i, encoding.get_scale_filter(), i))
+            outputs.append('-map "[v%d]" %s "%s"' % (i, encoding.get_encode_args(),
+                converted[i]))
+        lines = [Template(ENCODE_SH).substitute(
             ORIGINAL_FILE=os.path.join(self.work_dir, source_file),
-            CONVERTED_FILE=os.path.join(self.work_dir, target_file),
+            FILTER=";".join(graph),
+            OUTPUT_ARGS=" ".join(outputs),
+            CONVERTED_FILES=" ".join('"%s"' % c for c in converted),
+            CANCEL_POLL=str(self.config['cancelPoll']),
+            UPLOADED=self.uploaded_sh(target, targets))]
+        for (encoding, target_file, path) in zip(self.encodings, targets, converted):
+            lines.append(Template(UPLOAD_SH).substitute(
+                RCLONE_TARGET=target,
+                CONVERTED_FILE=path,
+                STAGE=encoding.name,
+                UPLOADED=self.uploaded_sh(target, [target_file])))
+        return ("".join(lines), targets)
+
+    def uploaded_sh(self, target, targets=None):
+        """
+        Shell condition checking that outputs are already uploaded in
+        full, all of this job's by default.
+        """
+        checks = []
+        for name in targets or self.targets:
+            path = target + "/" + name
+            checks.append('is_uploaded "%s" "%s.size"' % (path, path))
+        return " && ".join(checks)
+
+    def prepare(self):
+        """
+        Skip the conversion if a previous attempt uploaded every output.
+        """
+        super().prepare()
+        if self.state != JobState.Ready:
+            return
+        timing.start(self)
+        target = local_path(self.target_dir, self.config)
+        if not target:
+            return
+        paths = [os.path.join(target, t) for t in self.targets]
+        if all(uploaded(p, p + ".size") for p in paths):
+            skip(self, "Outputs already uploaded")
+
+    def success(self):
+        """
+        Release the workload and record the completion, returning the
+        merges if this was the last segment of its group.
+        """
+        if self.workload:
+            self.workload.done()
+        if self.store:
+            self.store.job_done(self.encodings[0].source, self.name)
+        if self.group and self.group.settled(self.segment):
+            timing.finish(self, 'cancelled')
+        else:
+            timing.finish(self)
+        jobs = self.group.completed(self) if self.group else []
+        return super().success() + timing.enqueued(jobs)
+
+    def failure(self):
+        """
+        Release the workload, returning the merges if this was the last
+        segment of its group.
+        """
+        if self.workload:
+            self.workload.done()
+        timing.finish(self, 'failure')
+        jobs = self.group.failed(self) if self.group else []
+        return super().failure() + timing.enqueued(jobs)
+
+
+class RangeConvert(Convert):
+    """
+    Convert a time range of a media file to one or more qualities,
+    reading the range straight from the source rather than from a split
+    segment.
+    The range is widened to the keyframes at or after its bounds, so the
+    ranges of a source fit together without gaps or overlaps.
+
+    Args:
+        source: rclone path to the original file.
+        encodings: Encoding objects, describing the desired outputs.
+        config: General job configuration.
+        target: rclone path to the directory for the converted range.
+        index: Index of the range, used to name the output.
+        start: Start of the range, in seconds.
+        end: End of the range in seconds, or None to convert to the end.
+        workload: Workload to release on completion.
+        store: PlanStore to record completion in.
+        group: SegmentGroup the job is an attempt of a segment for.
+    """
+
+    def __init__(self, source, encodings, config, target, index, start, end,
+            workload=None, store=None, group=None):
+        Job.__init__(self, config)
+        self.source = source
+        self.target_dir = target
+        self.encodings = encodings
+        self.workload = workload
+        self.store = store
+        self.group = group
+        self.segment = None
+        self.priority = 8
+
+        # Determine various filenames, matching those of split segments
+        filename = os.path.basename(source)
+        _, ext = os.path.splitext(filename)
+        segment_file = (config['pattern'] + ext) % index
+        (encode, self.targets) = self.encode(segment_file, target)
+        info = encodings[0].info
+
+        # Fill in the template
+        self.name = "convert:%s:%s" % (filename, ",".join(self.targets))
+        self.script = Template(RANGE_SH).substitute(
+            WORK_DIR=self.work_dir,
+            RCLONE_ARGS=self.config["rcloneArgs"],
+            RCLONE_SOURCE_DIR=os.path.dirname(source),
+            RCLONE_TARGET=target,
+            SERVE_ADDR=config['streamAddr'],
+            SOURCE_URL="http://%s/%s" % (config['streamAddr'], quote(filename)),
+            VIDEO_STREAM=str(info.video().stream_identifier),
+            START_TIME="%d" % start,
+            END_TIME="" if end is None else "%d" % end,
+            FFMPEG_ARGS=encodings[0].get_range_args(),
+            ORIGINAL_FILE=os.path.join(self.work_dir, segment_file),
+            ENCODE=encode,
+            OUTPUTS=outputs_sh(config),
+            STAGES=timing.STAGES_SH,
+            UPLOADED=self.uploaded_sh(target)
         )
+        total = info.general().duration / 1000.0
+        covered = (total if end is None else end) - start
+        timing.schedule(self, 'convert', encodings, covered)
@@ -2,8 +2,13 @@ import os
 from string import Template
 from jackhammer import Job, JobState
 
+from transcoder.jobs.outputs import outputs_sh, uploaded, local_path, skip
+from transcoder.jobs import timing
+
 MERGE_SH="""#!/bin/bash
 set -ex
+echo "Worker $$(hostname)"
+$STAGES
 
 export PATH="$$PATH:/opt/rclone"
 export LC_ALL=C.UTF-8
@@ -12,7 +17,14 @@ export LANG=C.UTF-8
 rm -rf /tmp/jackhammer*
 mkdir -p "$WORK_DIR"
 rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
-
+$OUTPUTS
+if is_uploaded "$RCLONE_TARGET/$TARGET_FILE" "$RCLONE_SOURCE/$TARGET_FILE.size"
+then
+  echo "Output already uploaded"
+  exit 0
+fi
+
+stage_begin subtitles
 set +e
 rclone $RCLONE_ARGS copy --include *.srt "$RCLONE_SOURCE" "$WORK_DIR"
 set -e
@@ -28,17 +40,24 @@ do
     rclone $RCLONE_ARGS copy "$SUB_BASE.$$L.$$E" "$RCLONE_TARGET"
   fi
 done
+stage_end subtitles
 
+stage_begin download
 rclone $RCLONE_ARGS copy --include $PATTERN "$RCLONE_SOURCE" "$WORK_DIR"
+stage_end download $$(size_of "$WORK_DIR"/$PATTERN)
+stage_begin concat
 ffmpeg -f concat -safe 0 -i \
         <(for f in "$WORK_DIR"/$PATTERN; do echo "file '$$f'"; done) \
         -c copy -movflags faststart -map 0 -metadata:s:a:0 language="$AUDIO_LANG" \
         "$CONVERTED_FILE"
-rclone $RCLONE_ARGS copy "$CONVERTED_FILE" "$RCLONE_TARGET"
+stage_end concat $$(size_of "$CONVERTED_FILE")
+stage_begin upload
+upload_sized "$CONVERTED_FILE" "$RCLONE_TARGET" "$RCLONE_SOURCE"
+stage_end upload $$(size_of "$CONVERTED_FILE")
 
 rm -rf "$WORK_DIR" """
 
-class Merge(Job):
+class Merge(timing.Timed, Job):
     """
     Merge a series of video segments.
     """
@@ -58,6 +77,7 @@ class Merge(Job):
         target_file = os.path.basename(self.target)
         sub_base = os.path.splitext(target_file)[0]
         pattern = "*." + encoding.name + "." + encoding.extension
+        self.sidecar = self.source + "/" + target_file + ".size"
 
         # Fill in the template
         self.name = "merge:%s" % target_file
@@ -69,32 +89,49 @@ class Merge(Job):
             CONVERTED_FILE=os.path.join(self.work_dir, target_file),
             AUDIO_LANG=encoding.info.lang,
             SUB_BASE=os.path.join(self.work_dir, sub_base),
-            PATTERN=pattern
+            PATTERN=pattern,
+            TARGET_FILE=target_file,
+            OUTPUTS=outputs_sh(config),
+            STAGES=timing.STAGES_SH
         )
+        timing.schedule(self, 'merge', [encoding],
+                encoding.info.general().duration / 1000.0)
 
     def prepare(self):
         """
-        Fail this job if any prereqs failed. 
+        Fail this job if any prereqs failed, other than best effort ones,
+        and skip it if a previous attempt already uploaded the output in
+        full. The output is only checked against its size sidecar here,
+        as probing it over the mount would hold up dispatch, and is
+        validated by the verifier once this job succeeds.
         """
         super().prepare()
         if self.state != JobState.Ready:
             return
 
         for job in self.prereqs:
-            if job.state != JobState.Success:
+            if job.state != JobState.Success and not getattr(job, 'best_effort', False):
                 self.state = JobState.Failure
                 return
 
+        timing.start(self)
+        target = local_path(self.target, self.config)
+        sidecar = local_path(self.sidecar, self.config)
+        if target and sidecar and uploaded(target, sidecar):
+            skip(self, "Output already uploaded")
+
     def success(self):
         """
-        Send a success notification.
+        Record the timing and send a success notification.
         """
+        timing.finish(self)
         self.encoding.success(self)
         return []
 
     def failure(self):
         """
-        Send a failure notification.
+        Record the outcome and send a failure notification.
         """
+        timing.finish(self, 'failure')
         self.encoding.failure(self)
         return []
@@ -0,0 +1,78 @@
+"""
+Helpers letting retried jobs skip work whose output was already
+uploaded. Uploads record the size of the file in a sidecar, so a
+present output can be told apart from a partial one, and are written
+under a name unique to the attempt before being moved into place, so
+concurrent attempts never write the same file.
+"""
+
+import os
+import logging
+from string import Template
+
+logger = logging.getLogger("replicant.transcoder")
+
+OUTPUTS_SH="""
+# Upload a file under a name unique to this attempt, move it into place
+# unless another attempt already has, then record its size in a sidecar
+# in the given directory
+upload_sized() {
+  local NAME=$$(basename "$$1")
+  local PART=".$$NAME.$$(hostname).$$$$.partial"
+  rclone $RCLONE_ARGS copyto "$$1" "$$2/$$PART"
+  if is_uploaded "$$2/$$NAME" "$$3/$$NAME.size"
+  then
+    rclone $RCLONE_ARGS deletefile "$$2/$$PART" || true
+    return 0
+  fi
+  rclone $RCLONE_ARGS moveto "$$2/$$PART" "$$2/$$NAME"
+  stat -c %s "$$1" | rclone $RCLONE_ARGS rcat "$$3/$$NAME.size"
+}
+
+# Succeeds if a file is present with the size recorded in its sidecar
+is_uploaded() {
+  local SIZE=$$(rclone $RCLONE_ARGS lsf --format s "$$1" 2>/dev/null || true)
+  local WANT=$$(rclone $RCLONE_ARGS cat "$$2" 2>/dev/null || true)
+  [ -n "$$SIZE" ] && [ "$$SIZE" = "$$WANT" ]
+}
+"""
+
+SKIP_SH="""#!/bin/bash
+echo "$MESSAGE"
+"""
+
+
+def outputs_sh(config):
+    """
+    Shell functions for recording and checking uploaded outputs.
+    """
+    return Template(OUTPUTS_SH).substitute(RCLONE_ARGS=config["rcloneArgs"])
+
+
+def uploaded(path, sidecar):
+    """
+    Check an output on the local mount against its size sidecar.
+    """
+    try:
+        with open(sidecar, 'r') as f:
+            return os.path.getsize(path) == int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+
+
+def local_path(path, config):
+    """
+    Map an rclone path to the local mount, or None if it is not mounted.
+    """
+    if not path.startswith(config['mountRemote']):
+        return None
+    return path.replace(config['mountRemote'], config['mountLocal'], 1)
+
+
+def skip(job, message):
+    """
+    Replace a job's script with one that succeeds immediately.
+    """
+    logger.info("Skipping job %s: %s", job, message)
+    job.script = Template(SKIP_SH).substitute(MESSAGE=message)
+    job.skipped = True
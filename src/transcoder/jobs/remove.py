@@ -1,8 +1,11 @@
 from string import Template
-from jackhammer import Job
+from jackhammer import Job, JobState
+
+from transcoder.jobs import timing
 
 REMOVE_SH="""#!/bin/bash
 set -ex
+echo "Worker $$(hostname)"
 
 export PATH="$$PATH:/opt/rclone"
 export LC_ALL=C.UTF-8
@@ -11,12 +14,13 @@ export LANG=C.UTF-8
 rclone $RCLONE_ARGS purge $DST || true
 """
 
-class Remove(Job):
+class Remove(timing.Timed, Job):
     """
     Remove a directory or file.
+    Encodings, where given, tie the job to its plan in the job history.
     """
 
-    def __init__(self, dst, config, prereqs=[]):
+    def __init__(self, dst, config, prereqs=[], encodings=None):
         super().__init__(config, prereqs=prereqs)
         self.dst = dst
         self.priority = 0
@@ -27,3 +31,18 @@ class Remove(Job):
             RCLONE_ARGS=config["rcloneArgs"],
             DST=self.dst
         )
+        timing.schedule(self, 'remove', encodings, 0)
+
+    def prepare(self):
+        super().prepare()
+        if self.state != JobState.Ready:
+            return
+        timing.start(self)
+
+    def success(self):
+        timing.finish(self)
+        return super().success()
+
+    def failure(self):
+        timing.finish(self, 'failure')
+        return super().failure()
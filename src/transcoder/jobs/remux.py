@@ -1,9 +1,14 @@
 import os
 from string import Template
-from jackhammer import Job
+from jackhammer import Job, JobState
+
+from transcoder.jobs.outputs import outputs_sh, uploaded, local_path, skip
+from transcoder.jobs import timing
 
 REMUX_SH="""#!/bin/bash
 set -ex
+echo "Worker $$(hostname)"
+$STAGES
 
 export PATH="$$PATH:/opt/rclone"
 export LC_ALL=C.UTF-8
@@ -11,9 +16,20 @@ export LANG=C.UTF-8
 
 rm -rf /tmp/jackhammer*
 mkdir -p "$WORK_DIR"
+$OUTPUTS
+if is_uploaded "$RCLONE_TARGET/$TARGET_FILE" "$SIZE_DIR/$TARGET_FILE.size"
+then
+  rclone $RCLONE_ARGS deletefile "$SIZE_DIR/$TARGET_FILE.size" || true
+  echo "Output already uploaded"
+  exit 0
+fi
+
+stage_begin download
 rclone $RCLONE_ARGS copy "$RCLONE_SOURCE" "$WORK_DIR"
+stage_end download $$(size_of "$ORIGINAL_FILE")
 rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
 
+stage_begin subtitles
 pip3 -q install subliminal
 subliminal download -l $SUB_LANG -e utf-8 -f --directory "$WORK_DIR" "$ORIGINAL_FILE"
 SUB=$$(find "$WORK_DIR" -type f -name *.srt)
@@ -45,13 +61,20 @@ do
     set -e
   done
 done
+stage_end subtitles
 
+stage_begin remux
 ffmpeg -i "$ORIGINAL_FILE" $FFMPEG_ARGS "$CONVERTED_FILE"
-rclone $RCLONE_ARGS copy "$CONVERTED_FILE" "$RCLONE_TARGET"
+stage_end remux $$(size_of "$CONVERTED_FILE")
+stage_begin upload
+upload_sized "$CONVERTED_FILE" "$RCLONE_TARGET" "$SIZE_DIR"
+stage_end upload $$(size_of "$CONVERTED_FILE")
 
-rm -rf "$WORK_DIR" """
+rm -rf "$WORK_DIR"
+rclone $RCLONE_ARGS deletefile "$SIZE_DIR/$TARGET_FILE.size" || true
+"""
 
-class Remux(Job):
+class Remux(timing.Timed, Job):
     """
     Job to remux a file using FFMPEG.
     Also extracts and organizes subtitles.
@@ -72,6 +95,8 @@ class Remux(Job):
         source_file = os.path.basename(self.source)
         target_file = os.path.basename(self.target)
         sub_base = os.path.splitext(target_file)[0]
+        size_dir = os.path.join(config['tmpDir'], 'sizes')
+        self.sidecar = size_dir + "/" + target_file + ".size"
 
         # Fill in the template
         self.name = "remux:%s" % target_file
@@ -84,19 +109,42 @@ class Remux(Job):
             ORIGINAL_FILE=os.path.join(self.work_dir, source_file),
             CONVERTED_FILE=os.path.join(self.work_dir, target_file),
             SUB_LANG=encoding.lang,
-            SUB_BASE=os.path.join(self.work_dir, sub_base)
+            SUB_BASE=os.path.join(self.work_dir, sub_base),
+            TARGET_FILE=target_file,
+            SIZE_DIR=size_dir,
+            OUTPUTS=outputs_sh(config),
+            STAGES=timing.STAGES_SH
         )
+        timing.schedule(self, 'remux', [encoding],
+                encoding.info.general().duration / 1000.0)
+
+    def prepare(self):
+        """
+        Skip the remux if a previous attempt already uploaded the output
+        in full, checked against its size sidecar rather than probed, as
+        for merges.
+        """
+        super().prepare()
+        if self.state != JobState.Ready:
+            return
+        timing.start(self)
+        target = local_path(self.target, self.config)
+        sidecar = local_path(self.sidecar, self.config)
+        if target and sidecar and uploaded(target, sidecar):
+            skip(self, "Output already uploaded")
 
     def success(self):
         """
-        Send a success notification.
+        Record the timing and send a success notification.
         """
+        timing.finish(self)
         self.encoding.success(self)
         return []
 
     def failure(self):
         """
-        Send a failure notification.
+        Record the outcome and send a failure notification.
         """
+        timing.finish(self, 'failure')
         self.encoding.failure(self)
         return []
@@ -1,15 +1,25 @@
 import os
 import re
+import math
+import inspect
 from string import Template
 from uuid import uuid4
-from jackhammer import Job
+from functools import partial
+from urllib.parse import quote
+from jackhammer import Job, JobState
 
 from transcoder.jobs.remove import Remove
 from transcoder.jobs.merge import Merge
 from transcoder.jobs.convert import Convert
+from transcoder import segments
+from transcoder.speculation import SegmentGroup
+from transcoder.workload import choose_parts
+from transcoder.jobs import timing
 
 SPLIT_SH="""#!/bin/bash
 set -ex
+echo "Worker $$(hostname)"
+$STAGES
 
 export PATH="$$PATH:/opt/rclone"
 export LC_ALL=C.UTF-8
@@ -17,9 +27,12 @@ export LANG=C.UTF-8
 
 rm -rf /tmp/jackhammer*
 mkdir -p "$WORK_DIR"
+stage_begin download
 rclone $RCLONE_ARGS copy "$RCLONE_SOURCE" "$WORK_DIR"
+stage_end download $$(size_of "$ORIGINAL_FILE")
 rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
 
+stage_begin subtitles
 pip3 -q install subliminal
 subliminal download -l $SUB_LANG -e utf-8 -f --directory "$WORK_DIR" "$ORIGINAL_FILE"
 SUB=$$(find "$WORK_DIR" -type f -name *.srt)
@@ -52,22 +65,193 @@ do
     rm "$$OUT"
   done
 done
+stage_end subtitles
 
-ffmpeg -i "$ORIGINAL_FILE" $FFMPEG_ARGS "$PATTERN"
+stage_begin segment
+mkdir -p "$PLAN_DIR"
+cat > "$PLAN_DIR/segments.py" <<'SEGMENTS_EOF'
+$SEGMENTER
+SEGMENTS_EOF
+CUTS=$$(ffprobe -v error -select_streams v:$VIDEO_STREAM -show_entries packet=pts_time,flags -of csv=p=0 "$ORIGINAL_FILE" | python3 "$PLAN_DIR/segments.py" $DURATION $PARTS || true)
+if [ -n "$$CUTS" ]
+then
+  SEGMENT_ARGS="-segment_times $$CUTS"
+else
+  SEGMENT_ARGS="-segment_time $SEGMENT_TIME"
+fi
+rm -rf "$PLAN_DIR"
+
+ffmpeg -i "$ORIGINAL_FILE" $FFMPEG_ARGS $$SEGMENT_ARGS -f segment "$PATTERN"
+stage_end segment $$(size_of "$WORK_DIR"/$SEGMENT_GLOB)
+stage_begin upload
 rclone $RCLONE_ARGS --exclude "$ORIGINAL_FILENAME" copy "$WORK_DIR" "$RCLONE_TARGET"
+stage_end upload $$(size_of "$WORK_DIR"/$SEGMENT_GLOB)
 echo "Completed $$(ls "$WORK_DIR" | grep -v ".srt$$" | grep -v "$ORIGINAL_FILENAME" | wc -l)"
 """
 
-class Split(Job):
+STREAM_SPLIT_SH="""#!/bin/bash
+set -ex
+echo "Worker $$(hostname)"
+$STAGES
+
+export PATH="$$PATH:/opt/rclone"
+export LC_ALL=C.UTF-8
+export LANG=C.UTF-8
+
+rm -rf /tmp/jackhammer*
+mkdir -p "$WORK_DIR"
+rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
+
+# Serve the source for ranged reads, rather than downloading it
+rclone $RCLONE_ARGS serve http "$RCLONE_SOURCE_DIR" --read-only --addr "$SERVE_ADDR" &
+SERVE_PID=$$!
+trap "kill $$SERVE_PID" EXIT
+for i in $$(seq 30)
+do
+  curl -sf -r 0-0 -o /dev/null "$SOURCE_URL" && break
+  sleep 1
+done
+
+# Subtitles are searched for by name, as the file is not local
+stage_begin subtitles
+pip3 -q install subliminal
+subliminal download -l $SUB_LANG -e utf-8 -f --directory "$WORK_DIR" "$ORIGINAL_FILE" || true
+SUB=$$(find "$WORK_DIR" -type f -name *.srt)
+if [ -n "$$SUB" ]
+then
+  mv "$$SUB" "$SUB_BASE.$SUB_LANG.srt"
+  rclone $RCLONE_ARGS copy "$SUB_BASE.$SUB_LANG.srt" "$RCLONE_TARGET"
+fi
+stage_end subtitles
+
+# Embedded text subtitles are extracted by the same pass as the segments
+SUB_ARGS=()
+SUB_FILES=()
+SUBS=$$(ffprobe -v error -show_entries stream=index:stream_tags=language:stream=codec_name -select_streams s -of compact=p=0:nk=1 "$SOURCE_URL" | grep -E '^[0-9]+\\|(subrip|ass|ssa|mov_text|webvtt|text)\\|' || true)
+for L in $$(echo "$$SUBS" | cut -d '|' -f 3 | sort | uniq)
+do
+  NUM=1
+  for SUB in $$(echo "$$SUBS" | grep $$L | cut -d '|' -f 1)
+  do
+    while :
+    do
+      if [ "$$NUM" -eq 1 ]; then
+        OUT="$SUB_BASE.$$L.srt"
+      else
+        OUT="$SUB_BASE.$$L$$NUM.srt"
+      fi
+      NUM=$$((NUM+1))
+      [ -f $$OUT ] || break
+    done
+    SUB_ARGS+=(-map 0:$$SUB "$$OUT")
+    SUB_FILES+=("$$OUT")
+  done
+done
+
+# Reading, segmenting and uploading overlap, so are reported as one stage
+stage_begin stream
+LIST="$WORK_DIR/segments.list"
+touch "$$LIST"
+ffmpeg -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 30 -i "$SOURCE_URL" \\
+        $FFMPEG_ARGS -segment_time $SEGMENT_TIME -f segment \\
+        -segment_list "$$LIST" -segment_list_type flat "$PATTERN" \\
+        "$${SUB_ARGS[@]}" &
+FFMPEG_PID=$$!
+
+# Upload segments as they are closed, pausing ffmpeg while too many
+# are waiting on disk
+UPLOADED=0
+SEGMENT_BYTES=0
+throttle() {
+  if [ $$(( $$(wc -l < "$$LIST") - UPLOADED )) -ge $MAX_SEGMENTS ]
+  then
+    kill -STOP $$FFMPEG_PID 2>/dev/null || true
+  else
+    kill -CONT $$FFMPEG_PID 2>/dev/null || true
+  fi
+}
+upload_segments() {
+  while [ "$$(wc -l < "$$LIST")" -gt "$$UPLOADED" ]
+  do
+    throttle
+    UPLOADED=$$((UPLOADED+1))
+    SEGMENT=$$(sed -n "$${UPLOADED}p" "$$LIST")
+    rclone $RCLONE_ARGS copy "$WORK_DIR/$$SEGMENT" "$RCLONE_TARGET"
+    SEGMENT_BYTES=$$((SEGMENT_BYTES + $$(size_of "$WORK_DIR/$$SEGMENT")))
+    rm -f "$WORK_DIR/$$SEGMENT"
+  done
+  throttle
+}
+while kill -0 $$FFMPEG_PID 2>/dev/null
+do
+  upload_segments
+  sleep 2
+done
+wait $$FFMPEG_PID
+upload_segments
+stage_end stream $$SEGMENT_BYTES
+
+set +e
+for OUT in "$${SUB_FILES[@]}"
+do
+  [ -s "$$OUT" ] && rclone $RCLONE_ARGS copy "$$OUT" "$RCLONE_TARGET"
+done
+set -e
+
+rm -rf "$WORK_DIR"
+echo "Completed $$UPLOADED"
+"""
+
+def segment_jobs(tmp_dir, pattern, count, encodings, config, workload=None,
+        store=None, skip=None, speculator=None):
+    """
+    Jobs converting the segments of a split into every encoding, each
+    convert producing every encoding of a segment. The merges follow
+    once every segment is converted.
+    Converts for which skip returns True are left out, as already done.
+    """
+    def finish(failures):
+        merges = [Merge(tmp_dir, e, config, failures) for e in encodings]
+
+        # Delete the temporary directory
+        return merges + [Remove(tmp_dir, config, merges, encodings)]
+
+    group = SegmentGroup(finish)
+    duration = encodings[0].info.general().duration / 1000.0
+    factories = [partial(Convert, tmp_dir + "/" + (pattern % i), encodings, config,
+        workload=workload, store=store, duration=duration / count)
+        for i in range(count)]
+    jobs = group.populate(factories, skip)
+    if workload:
+        workload.add(group.remaining())
+    if speculator and not group.finished():
+        speculator.register(group)
+    return jobs
+
+
+class Split(timing.Timed, Job):
     """
     Job to split a file into segments.
-    It then generates jobs to convert and merge the resulting segments
-    into a variety of formats.
+    Cut points are chosen on the worker from the source's keyframes, to
+    balance the length of the segments, falling back to a fixed segment
+    time. It then generates jobs to convert each resulting segment into
+    a variety of formats, and to merge the converted segments.
+
+    The number of segments is taken from the workload where given, and
+    otherwise from the encoding's fixed configuration.
+
+    In stream mode the source is served to ffmpeg over HTTP by rclone
+    instead of being downloaded, and segments are uploaded as they are
+    closed, keeping at most a few on the worker's disk. Cut points then
+    use a fixed segment time, as the keyframes are not known up front.
     """
 
-    def __init__(self, encodings, config):
+    def __init__(self, encodings, config, workload=None, store=None, speculator=None):
         super().__init__(config)
         self.encodings = encodings
+        self.workload = workload
+        self.store = store
+        self.speculator = speculator
         assert len(self.encodings) > 0, "Split requires at least one encoding"
 
         # Fix bases of paths
@@ -83,10 +267,18 @@ class Split(Job):
         self.pattern = config['pattern'] + ext
         sub_base = os.path.splitext(source_file)[0]
 
+        # Segmentation
+        info = encodings[0].info
+        duration = info.general().duration / 1000.0
+        self.parts = choose_parts(encodings, duration, workload)
+        if workload:
+            workload.add(self.parts)
+
         # Set command and name
         enc = "-".join([e.name for e in encodings])
         self.name = "split:%s:%s" % (source_file, enc)
-        self.script = Template(SPLIT_SH).substitute(
+        stream = config['splitMode'] == 'stream'
+        self.script = Template(STREAM_SPLIT_SH if stream else SPLIT_SH).substitute(
             WORK_DIR=self.work_dir,
             RCLONE_ARGS=config["rcloneArgs"],
             RCLONE_SOURCE=self.source,
@@ -94,10 +286,29 @@ class Split(Job):
             ORIGINAL_FILE=os.path.join(self.work_dir, source_file),
             ORIGINAL_FILENAME=source_file,
             PATTERN=os.path.join(self.work_dir, self.pattern),
+            SEGMENT_GLOB=re.sub(r"%\d*d", "*", self.pattern),
             SUB_LANG=encodings[0].lang,
             SUB_BASE=os.path.join(self.work_dir, sub_base),
-            FFMPEG_ARGS=encodings[0].get_split_args()
+            FFMPEG_ARGS=encodings[0].get_split_args(),
+            PLAN_DIR=self.work_dir + "-plan",
+            SEGMENTER=inspect.getsource(segments),
+            VIDEO_STREAM=str(info.video().stream_identifier),
+            DURATION="%.3f" % duration,
+            PARTS=str(self.parts),
+            SEGMENT_TIME=str(math.ceil(duration / self.parts)),
+            RCLONE_SOURCE_DIR=os.path.dirname(self.source),
+            SERVE_ADDR=config['streamAddr'],
+            SOURCE_URL="http://%s/%s" % (config['streamAddr'], quote(source_file)),
+            MAX_SEGMENTS=str(config['streamSegments']),
+            STAGES=timing.STAGES_SH
         )
+        timing.schedule(self, 'split', encodings, duration)
+
+    def prepare(self):
+        super().prepare()
+        if self.state != JobState.Ready:
+            return
+        timing.start(self)
 
     def success(self):
         # Find a complete line, with segment count
@@ -109,28 +320,25 @@ class Split(Job):
                 break
         if not num:
             return self.failure()
+        timing.finish(self)
+        if self.workload:
+            self.workload.done(self.parts)
+        if self.store:
+            self.store.set_parts(self.encodings[0].source, num)
 
-        # Setup the transcode jobs
-        jobs = []
-        merges = []
-        for encoding in self.encodings:
-            prereqs = []
-            for i in range(num):
-                src = self.tmp_dir + "/" + (self.pattern % i)
-                prereqs.append(Convert(src, encoding, self.config))
-            jobs.extend(prereqs)
-            merges.append(Merge(self.tmp_dir, encoding, self.config, prereqs))
-        jobs.extend(merges)
-
-        # Delete the temporary directory
-        jobs.append(Remove(self.tmp_dir, self.config, merges))
-        return jobs
+        return timing.enqueued(segment_jobs(self.tmp_dir, self.pattern, num,
+                self.encodings, self.config, self.workload, self.store,
+                speculator=self.speculator))
 
     def failure(self):
         """
         Send a notification for the job failure and
         schedule a cleanup of the temporary directory.
         """
+        timing.finish(self, 'failure')
+        if self.workload:
+            self.workload.done(self.parts)
         for enc in self.encodings:
             enc.failure(self)
-        return [Remove(self.tmp_dir, self.config)]
+        return timing.enqueued([Remove(self.tmp_dir, self.config,
+                encodings=self.encodings)])
@@ -0,0 +1,134 @@
+import os
+from string import Template
+from urllib.parse import quote
+from jackhammer import Job, JobState
+
+from transcoder.jobs import timing
+
+SUBTITLES_SH="""#!/bin/bash
+set -ex
+echo "Worker $$(hostname)"
+$STAGES
+
+export PATH="$$PATH:/opt/rclone"
+export LC_ALL=C.UTF-8
+export LANG=C.UTF-8
+
+rm -rf /tmp/jackhammer*
+mkdir -p "$WORK_DIR"
+rclone $RCLONE_ARGS mkdir "$RCLONE_TARGET"
+
+rclone $RCLONE_ARGS serve http "$RCLONE_SOURCE_DIR" --read-only --addr "$SERVE_ADDR" &
+SERVE_PID=$$!
+trap "kill $$SERVE_PID" EXIT
+for i in $$(seq 30)
+do
+  curl -sf -r 0-0 -o /dev/null "$SOURCE_URL" && break
+  sleep 1
+done
+
+stage_begin subtitles
+set +e
+pip3 -q install subliminal
+subliminal download -l $SUB_LANG -e utf-8 -f --directory "$WORK_DIR" "$ORIGINAL_FILE"
+SUB=$$(find "$WORK_DIR" -type f -name *.srt)
+if [ -n "$$SUB" ]
+then
+  mv "$$SUB" "$SUB_BASE.$SUB_LANG.srt"
+  rclone $RCLONE_ARGS copy "$SUB_BASE.$SUB_LANG.srt" "$RCLONE_TARGET"
+fi
+
+SUB_ARGS=()
+SUB_FILES=()
+SUBS=$$(ffprobe -v error -show_entries stream=index:stream_tags=language:stream=codec_name -select_streams s -of compact=p=0:nk=1 "$SOURCE_URL" | grep -E '^[0-9]+\\|(subrip|ass|ssa|mov_text|webvtt|text)\\|')
+for L in $$(echo "$$SUBS" | cut -d '|' -f 3 | sort | uniq)
+do
+  NUM=1
+  for SUB in $$(echo "$$SUBS" | grep $$L | cut -d '|' -f 1)
+  do
+    while :
+    do
+      if [ "$$NUM" -eq 1 ]; then
+        OUT="$SUB_BASE.$$L.srt"
+      else
+        OUT="$SUB_BASE.$$L$$NUM.srt"
+      fi
+      NUM=$$((NUM+1))
+      [ -f $$OUT ] || break
+    done
+    SUB_ARGS+=(-map 0:$$SUB "$$OUT")
+    SUB_FILES+=("$$OUT")
+  done
+done
+
+if [ $${#SUB_ARGS[@]} -gt 0 ]
+then
+  ffmpeg -reconnect 1 -reconnect_streamed 1 -i "$SOURCE_URL" -hide_banner -nostdin "$${SUB_ARGS[@]}"
+  for OUT in "$${SUB_FILES[@]}"
+  do
+    [ -s "$$OUT" ] && rclone $RCLONE_ARGS copy "$$OUT" "$RCLONE_TARGET"
+  done
+fi
+set -e
+stage_end subtitles $$(size_of "$WORK_DIR"/*.srt)
+
+rm -rf "$WORK_DIR" """
+
+class Subtitles(timing.Timed, Job):
+    """
+    Fetch and extract the subtitles of a file, reading it over HTTP.
+    Used by the range workflow, where no job downloads the whole file.
+    Subtitles are best effort, so this job only fails on setup errors,
+    and merges waiting on it run whether or not it succeeds.
+    """
+
+    best_effort = True
+
+    def __init__(self, encoding, config, target, store=None):
+        super().__init__(config)
+        self.encoding = encoding
+        self.store = store
+        self.priority = 6
+
+        # Fix bases of paths
+        self.source = encoding.source.replace(
+                config['mountLocal'], config['mountRemote'], 1)
+
+        # Determine various filenames
+        source_file = os.path.basename(self.source)
+        sub_base = os.path.splitext(source_file)[0]
+
+        # Fill in the template
+        self.name = "subtitles:%s" % source_file
+        self.script = Template(SUBTITLES_SH).substitute(
+            WORK_DIR=self.work_dir,
+            RCLONE_ARGS=config["rcloneArgs"],
+            RCLONE_SOURCE_DIR=os.path.dirname(self.source),
+            RCLONE_TARGET=target,
+            SERVE_ADDR=config['streamAddr'],
+            SOURCE_URL="http://%s/%s" % (config['streamAddr'], quote(source_file)),
+            ORIGINAL_FILE=os.path.join(self.work_dir, source_file),
+            SUB_LANG=encoding.lang,
+            SUB_BASE=os.path.join(self.work_dir, sub_base),
+            STAGES=timing.STAGES_SH
+        )
+        timing.schedule(self, 'subtitles', [encoding], 0)
+
+    def prepare(self):
+        super().prepare()
+        if self.state != JobState.Ready:
+            return
+        timing.start(self)
+
+    def success(self):
+        """
+        Record the completion.
+        """
+        timing.finish(self)
+        if self.store:
+            self.store.job_done(self.encoding.source, self.name)
+        return super().success()
+
+    def failure(self):
+        timing.finish(self, 'failure')
+        return super().failure()
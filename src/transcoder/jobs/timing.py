@@ -0,0 +1,152 @@
+"""
+Helpers timing jobs for the throughput model and job history, both
+reached through the jobs' encodings, and prioritising jobs by their
+predicted cost.
+Job scripts report their stages, such as downloads, encodes and
+uploads, on lines of their output parsed into a breakdown per job,
+which also gives the bytes each job read and wrote.
+"""
+
+import re
+import time
+
+import metrics
+from transcoder.throughput import encodings_key
+
+JOBS_ENQUEUED = metrics.counter("replicant_jobs_enqueued_total",
+        "Jobs handed to the scheduler, by kind.")
+JOBS_FINISHED = metrics.counter("replicant_jobs_finished_total",
+        "Jobs finished, by kind and outcome.")
+
+STAGES_SH="""
+# Report a stage of the job as "Stage NAME START END BYTES"
+declare -A STAGE_STARTS
+stage_begin() {
+  STAGE_STARTS[$1]=$(date +%s.%N)
+}
+stage_end() {
+  echo "Stage $1 ${STAGE_STARTS[$1]} $(date +%s.%N) ${2:-0}"
+}
+
+# Total size in bytes of the given files
+size_of() {
+  du -scbL "$@" 2>/dev/null | tail -n 1 | cut -f 1
+}
+"""
+
+STAGE = re.compile(r"^Stage (\S+) ([0-9.]+) ([0-9.]+) ([0-9]+)\s*$", re.MULTILINE)
+
+# Stages whose bytes were read from and written to the remote. Streamed
+# splits read the source and upload its segments in the same stage.
+INPUT_STAGES = ('download', 'stream')
+OUTPUT_STAGES = ('upload', 'stream', 'subtitles')
+
+
+def parse_stages(stdout):
+    """
+    Seconds spent and bytes moved in each stage reported by a job
+    script. Repeated stages are summed.
+    """
+    stages = {}
+    for (name, start, end, size) in STAGE.findall(stdout or ""):
+        stage = stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'count': 0})
+        stage['seconds'] += max(0.0, float(end) - float(start))
+        stage['bytes'] += int(size)
+        stage['count'] += 1
+    return stages
+
+
+def stage_bytes(stages, names):
+    """
+    Bytes moved by the stages of the given names, ignoring any
+    qualifier after a colon, such as the rendition of an upload.
+    """
+    return sum(stage.get('bytes', 0) for (name, stage) in stages.items()
+            if name.split(':')[0] in names)
+
+
+class Timed:
+    """
+    Mixin for jobs timed here, whose priority is worked out from their
+    predicted wall time whenever the scheduler reads it, so it rises as
+    their plan waits. Setting the priority sets its base band.
+    """
+
+    @property
+    def priority(self):
+        base = self.base_priority
+        if getattr(self, 'predicted', None) is None:
+            return base
+        return self.timed[0].model.priority(base, self.predicted, self.timed[0].created)
+
+    @priority.setter
+    def priority(self, value):
+        self.base_priority = value
+
+
+def schedule(job, kind, encodings, duration):
+    """
+    Predict the wall time of a job covering duration seconds of its
+    source, which orders it within its priority band.
+    """
+    job.kind = kind
+    job.timed = encodings
+    job.covered = duration
+    job.created = time.time()
+    job.started = None
+    job.attempts = 0
+    job.stages = {}
+    job.predicted = None
+    job.trace = encodings[0].trace.id if encodings else None
+    model = encodings[0].model if encodings else None
+    if not model:
+        return
+    job.predicted = model.predict(kind, encodings_key(encodings), encodings[0].info,
+            duration)
+
+
+def enqueued(jobs):
+    """
+    Count jobs as they are handed to the scheduler, returning them.
+    Jobs built but never queued, such as converts skipped on resuming a
+    plan, are not counted.
+    """
+    for job in jobs:
+        JOBS_ENQUEUED.inc(kind=job.kind)
+    return jobs
+
+
+def start(job):
+    job.started = time.time()
+    job.attempts += 1
+
+
+def finish(job, status='success'):
+    """
+    Break down a finished job's time by stage, and record it in the
+    history, along with the wall time of a job that did its work in the
+    throughput model.
+    """
+    if getattr(job, 'skipped', False):
+        status = 'skipped'
+    JOBS_FINISHED.inc(kind=job.kind, status=status)
+    if not job.timed:
+        return
+    now = time.time()
+    job.stages = parse_stages(getattr(job, 'stdout', None))
+    if job.started is not None:
+        job.stages['queued'] = {'seconds': job.started - job.created}
+        job.stages['run'] = {'seconds': now - job.started}
+
+    job.timed[0].trace.span(job.kind, job.created, now, job=job.name, status=status,
+            attempts=job.attempts, stages=job.stages)
+
+    model = job.timed[0].model
+    if model and status == 'success' and job.started is not None:
+        model.record(job.kind, encodings_key(job.timed), job.timed[0].info,
+                job.covered, now - job.started)
+
+    history = job.timed[0].history
+    if history:
+        history.record(job, status, stage_bytes(job.stages, INPUT_STAGES),
+                stage_bytes(job.stages, OUTPUT_STAGES))
@@ -1,42 +1,70 @@
 import os
+import math
+import time
 import logging
+from uuid import uuid4
+from functools import partial
+
+import tracing
 
 from transcoder.videoInfo import VideoInfo
-from transcoder.jobs.split import Split
+from transcoder.jobs.split import Split, segment_jobs
 from transcoder.jobs.remux import Remux
+from transcoder.jobs.convert import RangeConvert
+from transcoder.jobs.subtitles import Subtitles
+from transcoder.jobs.merge import Merge
+from transcoder.jobs.remove import Remove
+from transcoder.jobs.outputs import uploaded
+from transcoder.speculation import SegmentGroup
+from transcoder.workload import choose_parts
 
 logger = logging.getLogger("replicant.transcoder")
 
+# Containers indexed for seeking, so time ranges can be read over HTTP
+RANGE_FORMATS = ('MPEG-4', 'Matroska', 'WebM', 'QuickTime')
+
 class Plan:
     """
     Given an input video file, determine the necessary conversions
     to schedule.
     """
 
-    def __init__(self, source, target, encodings, finished, config):
+    def __init__(self, source, target, encodings, finished, config, cache=None,
+            workload=None, store=None, speculator=None):
         # Args
         self.source = source
         self.target = target
         self.desired = encodings
         self.callback = finished
         self.config = config
+        self.cache = cache
+        self.workload = workload
+        self.store = store
+        self.speculator = speculator
 
         # Source filename
         self.filename = os.path.basename(self.source)
+        self.trace = tracing.get(source)
 
         # State
         self.remaining_encodings = []
+        self.discarded = None
+        self.workflow = None
+        self.predicted = None
 
     def get_encodings(self):
         """
         Determine the necessary outputs for this file, given the
         the plan's desired encodings.
         """
+        start = time.time()
         try:
-            info = VideoInfo(self.source)
+            info = VideoInfo(self.source, cache=self.cache)
         except Exception as e:
             logger.warning("Failed to get video info for %s: %s", self.filename, str(e))
+            self.trace.span("probe", start, error=str(e))
             raise e
+        self.trace.span("probe", start)
 
         encodings = []
         for enc in self.desired:
@@ -66,9 +94,182 @@ class Plan:
             else:
                 split.append(enc)
 
-        # The rest will undergo a split/convert/merge workflow
+        # The rest will undergo a split/convert/merge workflow, or convert
+        # ranges of the source directly
         if len(split) > 0:
-            jobs.append(Split(split, self.config['job']))
+            workflow = self.choose_workflow(split[0].info)
+            self.workflow = workflow
+            self.predicted = self.predict(workflow, split)
+            record = self.resumable(workflow)
+            if workflow == 'range':
+                jobs.extend(self.get_range_jobs(split, record))
+            else:
+                jobs.extend(self.get_split_jobs(split, record))
+        else:
+            jobs.extend(self.discard())
+        return jobs
+
+    def predict(self, workflow, encodings):
+        """
+        Predicted worker time of converting the source by a workflow, or
+        None without a throughput model.
+        """
+        model = encodings[0].model
+        if not model:
+            return None
+        kinds = ('convert', 'merge') if workflow == 'range' else ('split', 'convert', 'merge')
+        return model.file_cost(encodings, kinds)
+
+    def discard(self):
+        """
+        Jobs removing the temporary directory of a stored plan for a
+        source that no longer needs converting.
+        """
+        record = self.store.get(self.source) if self.store else None
+        if not record:
+            return []
+        logger.info("Discarding stored plan for %s", self)
+        self.discarded = record.tmp_dir
+        return self.cleanup()
+
+    def choose_workflow(self, info):
+        """
+        Choose between splitting the source and reading ranges of it.
+        The configured workflow applies unless one is set for a directory
+        containing the source. 'auto' reads ranges of sources long enough
+        for the split's round trip of the segments to matter. Sources that
+        cannot be range read are always split.
+        """
+        workflow = self.config['workflow']
+        paths = self.config['workflowPaths']
+        for path in sorted(paths, key=len, reverse=True):
+            if self.source.startswith(path.rstrip('/') + '/'):
+                workflow = paths[path]
+                break
+
+        general = info.general()
+        duration = (general.duration or 0) / 1000.0
+        if general.format not in RANGE_FORMATS or duration <= 0:
+            if workflow != 'split':
+                logger.debug("Splitting %s, %s cannot be range read", self,
+                        general.format)
+            return 'split'
+        if workflow == 'auto':
+            return 'range' if duration >= self.config['rangeMinDuration'] else 'split'
+        return workflow
+
+    def resumable(self, workflow):
+        """
+        Find a stored plan for this source that can be resumed, being of
+        the same workflow with its temporary directory still in place.
+        An unusable stored plan has its temporary directory removed.
+        """
+        record = self.store.get(self.source) if self.store else None
+        if not record:
+            return None
+        if record.workflow == workflow and record.parts and self.local_tmp(record.tmp_dir):
+            logger.info("Resuming plan %s with %d segments, %d jobs done", self,
+                    record.parts, len(record.done))
+            return record
+        logger.info("Discarding stored plan for %s", self)
+        self.discarded = record.tmp_dir
+        return None
+
+    def local_tmp(self, tmp_dir):
+        """
+        Path of a temporary directory on the local mount, or None if it is
+        missing.
+        """
+        config = self.config['job']
+        if not tmp_dir.startswith(config['mountRemote']):
+            return None
+        path = tmp_dir.replace(config['mountRemote'], config['mountLocal'], 1)
+        return path if os.path.isdir(path) else None
+
+    def completed(self, record):
+        """
+        Returns a predicate for converts recorded as done whose outputs
+        are all uploaded in full to the temporary directory.
+        """
+        path = self.local_tmp(record.tmp_dir)
+        def skip(job):
+            if job.name not in record.done:
+                return False
+            outputs = [os.path.join(path, t) for t in job.targets]
+            return all(uploaded(p, p + ".size") for p in outputs)
+        return skip
+
+    def cleanup(self):
+        """
+        Jobs removing the temporary directory of a discarded plan.
+        """
+        if not self.discarded:
+            return []
+        return [Remove(self.discarded, self.config['job'])]
+
+    def get_split_jobs(self, encodings, record=None):
+        """
+        Generate the split job, or on resuming a split that completed, the
+        remaining converts and the merges.
+        """
+        config = self.config['job']
+        if record:
+            _, ext = os.path.splitext(self.filename)
+            return segment_jobs(record.tmp_dir, config['pattern'] + ext,
+                    record.parts, encodings, config, self.workload, self.store,
+                    self.completed(record), self.speculator)
+
+        split = Split(encodings, config, self.workload, self.store, self.speculator)
+        if self.store:
+            self.store.begin(self.source, 'split', split.tmp_dir)
+        return self.cleanup() + [split]
+
+    def get_range_jobs(self, encodings, record=None):
+        """
+        Generate jobs converting time ranges of the source, for each
+        encoding, then merging them. Unlike the split workflow, the
+        original segments are never written to the temporary directory.
+        """
+        config = self.config['job']
+        source = self.source.replace(config['mountLocal'], config['mountRemote'], 1)
+        jobs = self.cleanup()
+
+        # Segmentation, keeping that of a resumed plan
+        duration = encodings[0].info.general().duration / 1000.0
+        if record:
+            (tmp_dir, parts) = (record.tmp_dir, record.parts)
+        else:
+            tmp_dir = os.path.join(config['tmpDir'], str(uuid4()))
+            parts = choose_parts(encodings, duration, self.workload)
+            if self.store:
+                self.store.begin(self.source, 'range', tmp_dir, parts)
+        length = math.ceil(duration / parts)
+        skip = self.completed(record) if record else None
+
+        prereqs = []
+        subtitles = Subtitles(encodings[0], config, tmp_dir, self.store)
+        if not (record and subtitles.name in record.done):
+            prereqs.append(subtitles)
+            jobs.append(subtitles)
+
+        # Merges follow once every range is converted
+        def finish(failures):
+            merges = [Merge(tmp_dir, e, config, prereqs + failures) for e in encodings]
+
+            # Delete the temporary directory
+            return merges + [Remove(tmp_dir, config, merges, encodings)]
+
+        group = SegmentGroup(finish)
+        factories = []
+        for i in range(parts):
+            end = (i + 1) * length if i + 1 < parts else None
+            factories.append(partial(RangeConvert, source, encodings, config, tmp_dir,
+                i, i * length, end, workload=self.workload, store=self.store))
+        jobs.extend(group.populate(factories, skip))
+        if self.workload:
+            self.workload.add(group.remaining())
+        if self.speculator and not group.finished():
+            self.speculator.register(group)
         return jobs
 
     def finished(self, encoding):
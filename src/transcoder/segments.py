@@ -0,0 +1,117 @@
+"""
+Segmentation planning for the split workflow.
+
+This module only uses the standard library, as it is also copied into
+the split job's script and run on the worker against the keyframe index
+of the downloaded source:
+
+    ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags \\
+        -of csv=p=0 input.mkv | python3 segments.py DURATION PARTS
+"""
+
+import sys
+import bisect
+
+# Precision of the makespan search, in seconds.
+PRECISION = 0.01
+
+
+def read_keyframes(lines):
+    """
+    Parse 'pts_time,flags' lines from ffprobe, returning the sorted
+    times of keyframe packets.
+    """
+    times = set()
+    for line in lines:
+        fields = line.strip().split(',')
+        if len(fields) < 2 or not 'K' in fields[1]:
+            continue
+        try:
+            times.add(float(fields[0]))
+        except ValueError:
+            continue
+    return sorted(times)
+
+
+def greedy_cuts(keyframes, duration, length):
+    """
+    Cut as late as possible while keeping every segment within length.
+    Returns the cut times, or None if a gap between keyframes is longer
+    than length.
+    """
+    cuts = []
+    start = 0.0
+    while duration - start > length:
+        i = bisect.bisect_right(keyframes, start + length) - 1
+        if i < 0 or keyframes[i] <= start:
+            return None
+        start = keyframes[i]
+        cuts.append(start)
+    return cuts
+
+
+def balanced_cuts(keyframes, duration, parts):
+    """
+    Choose keyframe cut points giving at most parts segments, minimising
+    the longest segment.
+    """
+    keyframes = [k for k in keyframes if 0 < k < duration]
+    if parts <= 1 or not keyframes:
+        return []
+
+    low = duration / parts
+    high = duration
+    best = []
+    while high - low > PRECISION:
+        length = (low + high) / 2
+        cuts = greedy_cuts(keyframes, duration, length)
+        if cuts is not None and len(cuts) < parts:
+            (high, best) = (length, cuts)
+        else:
+            low = length
+    return best if best else greedy_cuts(keyframes, duration, high) or []
+
+
+def fixed_cuts(keyframes, duration, length):
+    """
+    Cut points produced by the segment muxer's segment_time option, at
+    the first keyframe at or after each multiple of length.
+    """
+    cuts = []
+    boundary = length
+    for k in keyframes:
+        if k >= duration:
+            break
+        if k >= boundary:
+            cuts.append(k)
+            while boundary <= k:
+                boundary += length
+    return cuts
+
+
+def segment_lengths(cuts, duration):
+    points = [0.0] + list(cuts) + [duration]
+    return [b - a for (a, b) in zip(points, points[1:])]
+
+
+def format_cuts(cuts):
+    """
+    Format cut times for the segment_times option. Times are rounded
+    down, so each keyframe falls at or after its cut time.
+    """
+    return ",".join("%.3f" % (int(c * 1000) / 1000.0) for c in cuts)
+
+
+def main(args):
+    duration = float(args[0])
+    parts = int(args[1])
+    keyframes = read_keyframes(sys.stdin)
+    cuts = balanced_cuts(keyframes, duration, parts)
+    if not cuts:
+        return 1
+    print(format_cuts(cuts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
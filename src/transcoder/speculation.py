@@ -0,0 +1,171 @@
+import time
+import math
+import logging
+import statistics
+from threading import Thread, Event, Lock
+
+from transcoder.jobs import timing
+
+logger = logging.getLogger("replicant.transcoder")
+
+
+class SegmentGroup:
+    """
+    The convert jobs for the segments of one plan.
+    A slow segment may be given a second, speculative attempt, and
+    whichever attempt finishes first counts, the other cancelling itself
+    once it sees the output uploaded. The merges are created by the
+    finish callback once every segment is converted, or has failed.
+
+    Args:
+        finish: Called with the failed jobs, returning the jobs to run
+            once all segments are finished.
+    """
+
+    def __init__(self, finish):
+        self.finish = finish
+        self.factories = {}
+        self.running = {}
+        self.durations = {}
+        self.failures = []
+        self.closed = False
+        self.lock = Lock()
+
+    def populate(self, factories, skip=None):
+        """
+        Create the first attempt of each segment from its factory,
+        leaving out those for which skip returns True. Returns the jobs,
+        or the finishing jobs directly if no segment needs converting.
+        """
+        jobs = []
+        for (index, factory) in enumerate(factories):
+            job = factory(group=self)
+            if skip and skip(job):
+                continue
+            job.segment = index
+            self.factories[index] = factory
+            self.running[index] = [job]
+            jobs.append(job)
+        if not jobs:
+            self.closed = True
+            return self.finish([])
+        return jobs
+
+    def settled(self, segment):
+        """
+        Whether a segment has already finished, by another attempt.
+        """
+        with self.lock:
+            return segment not in self.running
+
+    def completed(self, job):
+        """
+        Record a successful attempt, returning any jobs to run next.
+        """
+        with self.lock:
+            attempts = self.running.pop(job.segment, None)
+            if attempts is None:
+                logger.debug("Ignoring later attempt: %s", job)
+                return []
+            self.durations[job.segment] = time.time() - job.started
+            if len(attempts) > 1:
+                logger.info("Speculative race for %s won by %s", job,
+                        "copy" if job is not attempts[0] else "original")
+            return self.check()
+
+    def failed(self, job):
+        """
+        Record a failed attempt. The segment fails once no attempt of it
+        remains running.
+        """
+        with self.lock:
+            attempts = self.running.get(job.segment)
+            if attempts is None or job not in attempts:
+                return []
+            attempts.remove(job)
+            if attempts:
+                return []
+            del self.running[job.segment]
+            self.failures.append(job)
+            return self.check()
+
+    def check(self):
+        if self.running or self.closed:
+            return []
+        self.closed = True
+        return self.finish(list(self.failures))
+
+    def stragglers(self, factor, min_done):
+        """
+        Create a second attempt of each segment running for longer than
+        factor times the median of the finished segments, once at least
+        min_done of the segments have finished.
+        """
+        with self.lock:
+            total = len(self.durations) + len(self.running)
+            if self.closed or len(self.durations) < max(1, math.ceil(min_done * total)):
+                return []
+            limit = factor * statistics.median(self.durations.values())
+            now = time.time()
+            jobs = []
+            for (index, attempts) in self.running.items():
+                job = attempts[0]
+                if len(attempts) > 1 or getattr(job, 'started', None) is None:
+                    continue
+                if now - job.started > limit:
+                    copy = self.factories[index](group=self)
+                    copy.segment = index
+                    attempts.append(copy)
+                    jobs.append(copy)
+            return jobs
+
+    def remaining(self):
+        """
+        Number of segments not yet finished.
+        """
+        with self.lock:
+            return len(self.running)
+
+    def finished(self):
+        return self.closed
+
+
+class Speculator(Thread):
+    """
+    Periodically looks for straggling segments in the active groups and
+    schedules a speculative attempt for each, while workers are free.
+    """
+
+    def __init__(self, enqueue, workload, config):
+        super().__init__(daemon=True)
+        self.name = "replicant.speculator"
+        self.enqueue = enqueue
+        self.workload = workload
+        self.interval = config['interval']
+        self.factor = config['factor']
+        self.min_done = config['minDone']
+        self.groups = []
+        self.lock = Lock()
+        self.shutdown_flag = Event()
+
+    def register(self, group):
+        with self.lock:
+            self.groups.append(group)
+
+    def run(self):
+        while not self.shutdown_flag.wait(self.interval):
+            with self.lock:
+                self.groups = [g for g in self.groups if not g.finished()]
+                groups = list(self.groups)
+            for group in groups:
+                if self.workload and self.workload.free_slots() == 0:
+                    break
+                for job in group.stragglers(self.factor, self.min_done):
+                    logger.info("Scheduling speculative job: %s", job)
+                    if self.workload:
+                        self.workload.add(1)
+                    self.enqueue(job)
+                    timing.enqueued([job])
+
+    def shutdown(self):
+        self.shutdown_flag.set()
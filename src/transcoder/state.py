@@ -0,0 +1,90 @@
+import time
+import sqlite3
+import logging
+from threading import Lock
+from collections import namedtuple
+
+logger = logging.getLogger("replicant.transcoder")
+
+PLAN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    source TEXT PRIMARY KEY,
+    workflow TEXT NOT NULL,
+    tmp_dir TEXT NOT NULL,
+    parts INTEGER,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    source TEXT NOT NULL,
+    name TEXT NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (source, name)
+);
+"""
+
+PlanRecord = namedtuple('PlanRecord', ['source', 'workflow', 'tmp_dir', 'parts', 'done'])
+
+
+class PlanStore:
+    """
+    Persistent record of the plans in progress, so a restarted
+    controller can re-attach to their temporary directories instead of
+    starting over. Each plan records its workflow, temporary directory
+    and segment count, along with the names of its finished jobs.
+    """
+
+    def __init__(self, config):
+        self.lock = Lock()
+        self.db = sqlite3.connect(config['path'], check_same_thread=False)
+        self.db.executescript(PLAN_SCHEMA)
+
+    def begin(self, source, workflow, tmp_dir, parts=None):
+        """
+        Record a new plan for a source, replacing any previous one.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE source = ?", (source,))
+            self.db.execute("INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)",
+                    (source, workflow, tmp_dir, parts, time.time()))
+            self.db.commit()
+
+    def set_parts(self, source, parts):
+        """
+        Record the number of segments once known.
+        """
+        with self.lock:
+            self.db.execute("UPDATE plans SET parts = ? WHERE source = ?", (parts, source))
+            self.db.commit()
+
+    def job_done(self, source, name):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                    (source, name, time.time()))
+            self.db.commit()
+
+    def get(self, source):
+        """
+        Return the PlanRecord for a source, or None.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT source, workflow, tmp_dir, parts FROM plans "
+                    "WHERE source = ?", (source,)).fetchone()
+            if not row:
+                return None
+            done = self.db.execute("SELECT name FROM jobs WHERE source = ?",
+                    (source,)).fetchall()
+        return PlanRecord(*row, set(name for (name,) in done))
+
+    def finish(self, source):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE source = ?", (source,))
+            self.db.execute("DELETE FROM plans WHERE source = ?", (source,))
+            self.db.commit()
+
+    def sources(self):
+        """
+        Sources with a plan in progress, oldest first.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT source FROM plans ORDER BY created").fetchall()
+        return [source for (source,) in rows]
@@ -15,6 +15,7 @@ SuccessReport = Template(
   Source: $source
   Target: $target
   Encoding: $encoding
+  Trace: $trace
 
 Encoding Report:
 $encoding_report
@@ -30,6 +31,7 @@ FailureReport = Template(
   Source: $source
   Target: $target
   Encoding: $encoding
+  Trace: $trace
 
 Job Report:
 $job""")
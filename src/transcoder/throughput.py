@@ -0,0 +1,167 @@
+import time
+import math
+import sqlite3
+import logging
+from threading import Lock
+
+logger = logging.getLogger("replicant.transcoder")
+
+SAMPLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    duration REAL NOT NULL,
+    pixels INTEGER NOT NULL,
+    bit_rate INTEGER NOT NULL,
+    wall REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_key ON samples (kind, key, recorded);
+"""
+
+# Kinds of job whose cost scales with the decoded pixels, rather than
+# the bytes transferred.
+ENCODE_KINDS = ('convert',)
+
+
+def work(kind, duration, pixels, bit_rate):
+    """
+    Units of work in a job: megapixel seconds for encodes, megabytes of
+    source for transfer bound jobs.
+    """
+    if kind in ENCODE_KINDS:
+        return duration * pixels / 1e6
+    return duration * bit_rate / 8e6
+
+
+def encodings_key(encodings):
+    return ",".join(e.name for e in encodings)
+
+
+class ThroughputModel:
+    """
+    Records the wall time of completed jobs along with the properties of
+    their source, and fits a linear model of wall time against the work
+    in the job, per kind of job and set of encodings.
+    Predictions size segments to a target wall time and order the queue,
+    shortest predicted work first, with older plans aged forward.
+    """
+
+    def __init__(self, config):
+        self.samples = config['samples']
+        self.min_samples = config['minSamples']
+        self.target_wall = config['targetWall']
+        self.scale = config['scale']
+        self.aging = config['agingWindow']
+        self.lock = Lock()
+        self.fits = {}
+        self.db = sqlite3.connect(config['path'], check_same_thread=False)
+        self.db.executescript(SAMPLE_SCHEMA)
+
+    def record(self, kind, key, info, duration, wall):
+        """
+        Record a completed job, covering duration seconds of the source.
+        """
+        pixels = info.resolution()
+        bit_rate = info.general().overall_bit_rate or 0
+        with self.lock:
+            self.db.execute("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (kind, key, duration, pixels, bit_rate, wall, time.time()))
+            self.db.commit()
+            self.fits.pop((kind, key), None)
+        logger.debug("Recorded %s %s: %.0fs of source in %.0fs", kind, key,
+                duration, wall)
+
+    def fit(self, kind, key):
+        """
+        Least squares fit of wall time against work over the most recent
+        samples, returning (fixed, per unit) or None without enough
+        samples for a usable fit.
+        """
+        with self.lock:
+            if (kind, key) in self.fits:
+                return self.fits[(kind, key)]
+            rows = self.db.execute(
+                    "SELECT duration, pixels, bit_rate, wall FROM samples "
+                    "WHERE kind = ? AND key = ? ORDER BY recorded DESC LIMIT ?",
+                    (kind, key, self.samples)).fetchall()
+            result = None
+            if len(rows) >= self.min_samples:
+                xs = [work(kind, d, p, b) for (d, p, b, _) in rows]
+                ys = [w for (_, _, _, w) in rows]
+                result = linear_fit(xs, ys)
+            self.fits[(kind, key)] = result
+            return result
+
+    def predict(self, kind, key, info, duration):
+        """
+        Predicted wall time in seconds of a job covering duration seconds
+        of the source, or None if not yet known.
+        """
+        model = self.fit(kind, key)
+        if not model:
+            return None
+        (fixed, rate) = model
+        bit_rate = info.general().overall_bit_rate or 0
+        return fixed + rate * work(kind, duration, info.resolution(), bit_rate)
+
+    def file_cost(self, encodings, kinds):
+        """
+        Predicted total worker time of the jobs of the given kinds taking
+        a file to its encodings, counting unknown kinds as free. Merges
+        are run once per encoding.
+        """
+        info = encodings[0].info
+        duration = info.general().duration / 1000.0
+        cost = 0
+        for kind in kinds:
+            groups = [[e] for e in encodings] if kind == 'merge' else [encodings]
+            for group in groups:
+                cost += self.predict(kind, encodings_key(group), info, duration) or 0
+        return cost
+
+    def segment_parts(self, key, info, duration):
+        """
+        Number of segments keeping each convert within the target wall
+        time, or None if not yet known.
+        """
+        model = self.fit('convert', key)
+        if not model:
+            return None
+        (fixed, rate) = model
+        per_second = rate * info.resolution() / 1e6
+        budget = self.target_wall - fixed
+        if per_second <= 0 or budget <= 0:
+            return None
+        return max(1, math.ceil(duration * per_second / budget))
+
+    def priority(self, base, predicted, created):
+        """
+        Priority of a job within its base band, raised for shorter
+        predicted work and for plans that have waited longer. Jobs
+        without a prediction keep their base priority.
+        """
+        if predicted is None:
+            return base
+        shortness = 0.5 * self.scale / (self.scale + max(0, predicted))
+        age = 0.49 * min(1.0, (time.time() - created) / self.aging)
+        return base + shortness + age
+
+
+def linear_fit(xs, ys):
+    """
+    Ordinary least squares for y = a + b * x, returning (a, b), or None
+    if the slope is not positive. A single distinct x gives a fit
+    through the origin.
+    """
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var = sum((x - mean_x) ** 2 for x in xs)
+    if var == 0:
+        return (0.0, mean_y / mean_x) if mean_x > 0 and mean_y > 0 else None
+    cov = sum((x - mean_x) * (y - mean_y) for (x, y) in zip(xs, ys))
+    slope = cov / var
+    if slope <= 0:
+        return None
+    return (max(0.0, mean_y - slope * mean_x), slope)
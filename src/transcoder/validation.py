@@ -0,0 +1,102 @@
+import time
+import sqlite3
+import struct
+import logging
+from threading import Lock
+
+logger = logging.getLogger("replicant.transcoder")
+
+VERDICT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    path TEXT NOT NULL,
+    encoding TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    valid INTEGER NOT NULL,
+    msg TEXT NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (path, encoding)
+);
+CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used);
+"""
+
+BOX = struct.Struct('>I4s')
+
+# Top level boxes read before giving up on finding moov or mdat.
+MAX_BOXES = 16
+
+
+class ValidationCache:
+    """
+    Persistent record of validation verdicts, keyed by target path,
+    size, mtime and encoding name, so unchanged targets are not probed
+    again. The least recently used entries are evicted beyond the cap.
+    """
+
+    def __init__(self, config):
+        self.max_entries = config['maxEntries']
+        self.lock = Lock()
+        self.db = sqlite3.connect(config['path'], check_same_thread=False)
+        self.db.executescript(VERDICT_SCHEMA)
+
+    def get(self, path, key, encoding):
+        """
+        Return the cached (valid, msg) verdict, or None.
+        """
+        (size, mtime) = key
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT valid, msg FROM verdicts WHERE path = ? AND encoding = ? "
+                    "AND size = ? AND mtime = ?", (path, encoding, size, mtime)).fetchone()
+            if not row:
+                return None
+            self.db.execute("UPDATE verdicts SET used = ? WHERE path = ? AND encoding = ?",
+                    (time.time(), path, encoding))
+            self.db.commit()
+        return (bool(row[0]), row[1])
+
+    def put(self, path, key, encoding, verdict):
+        (size, mtime) = key
+        (valid, msg) = verdict
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, encoding, size, mtime, int(valid), msg, time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        (count,) = self.db.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+        if count <= self.max_entries:
+            return
+        self.db.execute(
+                "DELETE FROM verdicts WHERE rowid IN "
+                "(SELECT rowid FROM verdicts ORDER BY used LIMIT ?)",
+                (count - self.max_entries,))
+
+
+def mp4_layout(path):
+    """
+    Read the top level box headers of a file.
+    Returns None if the file is not an MP4 container, otherwise whether
+    the moov box precedes the media data.
+    """
+    with open(path, 'rb') as f:
+        offset = 0
+        for i in range(MAX_BOXES):
+            f.seek(offset)
+            header = f.read(BOX.size)
+            if len(header) < BOX.size:
+                break
+            (size, kind) = BOX.unpack(header)
+            if i == 0 and kind != b'ftyp':
+                return None
+            if kind == b'moov':
+                return True
+            if kind == b'mdat':
+                return False
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+            if size < BOX.size:
+                break
+            offset += size
+    return None
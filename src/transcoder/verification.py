@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+import traceback
+from threading import Timer, Lock, current_thread
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger("replicant.transcoder")
+
+VERIFY_SECONDS = metrics.summary("replicant_verification_seconds",
+        "Time from a finished job to the verification of its encoding, by outcome.")
+
+
+class Verifier:
+    """
+    Verifies completed encodings on a pool of workers, so job callbacks
+    return immediately. A target not yet visible on the mount is retried
+    with exponential backoff until the timeout, and failed verifications
+    are retried up to the attempt limit.
+    """
+
+    def __init__(self, notifications, config):
+        self.notifications = notifications
+        self.timeout = config['timeout']
+        self.delay = config['delay']
+        self.max_delay = config['maxDelay']
+        self.attempts = config['attempts']
+        self.pool = ThreadPoolExecutor(max_workers=config['workers'],
+                thread_name_prefix="replicant.verify")
+        self.lock = Lock()
+        self.timers = set()
+        self.closed = False
+
+    def submit(self, encoding, job):
+        """
+        Queue verification of an encoding produced by a job. Jobs may
+        still finish while the scheduler joins its workers after shutdown,
+        so their verifications are dropped.
+        """
+        with self.lock:
+            if self.closed:
+                logger.warning("Dropping verification of %s on shutdown", encoding)
+                return
+            self.pool.submit(self.verify, encoding, job, time.time(), 0, 0)
+
+    def verify(self, encoding, job, start, retries, failures):
+        """
+        Verify the encoding, rescheduling while its target is missing or
+        verification fails.
+        """
+        if not os.path.isfile(encoding.target) and time.time() - start < self.timeout:
+            self.retry(encoding, job, start, retries, failures)
+            return
+
+        try:
+            encoding.verify(job)
+            VERIFY_SECONDS.observe(time.time() - start, result="verified")
+            encoding.trace.span("verify", start, encoding=encoding.name, retries=retries)
+        except Exception as e:
+            logger.error("Verification Failure: %s %s", encoding, str(e))
+            logger.error(traceback.format_exc())
+            if failures + 1 < self.attempts:
+                self.retry(encoding, job, start, retries, failures + 1)
+            else:
+                VERIFY_SECONDS.observe(time.time() - start, result="failed")
+                encoding.trace.span("verify", start, encoding=encoding.name,
+                        retries=retries, failed=True)
+                self.notifications.send_exception(e)
+
+    def retry(self, encoding, job, start, retries, failures):
+        """
+        Schedule another verification attempt after a backoff delay.
+        """
+        delay = min(self.max_delay, self.delay * 2 ** retries)
+        logger.debug("Verifying %s again in %.1fs", encoding, delay)
+        with self.lock:
+            if self.closed:
+                logger.warning("Dropping verification of %s on shutdown", encoding)
+                return
+            timer = Timer(delay, self.resubmit,
+                    args=(encoding, job, start, retries + 1, failures))
+            timer.daemon = True
+            self.timers.add(timer)
+        timer.start()
+
+    def resubmit(self, *args):
+        """
+        Timer callback, run on the timer's own thread.
+        """
+        with self.lock:
+            self.timers.discard(current_thread())
+            if self.closed:
+                return
+            self.pool.submit(self.verify, *args)
+
+    def shutdown(self):
+        """
+        Finish verifications in progress, dropping pending retries.
+        """
+        with self.lock:
+            self.closed = True
+            for timer in self.timers:
+                timer.cancel()
+            if self.timers:
+                logger.warning("Dropped %d pending verifications", len(self.timers))
+            self.timers = set()
+        self.pool.shutdown(wait=True)
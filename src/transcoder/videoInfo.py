@@ -1,6 +1,16 @@
+import os
+import time
+import json
 import pprint
+import sqlite3
+import logging
 import yaml
-from pymediainfo import MediaInfo
+from threading import Lock
+from pymediainfo import MediaInfo, Track
+
+import metrics
+
+logger = logging.getLogger("replicant.transcoder")
 
 VIDEO_FIELDS = [
     'format',
@@ -74,15 +84,119 @@ def get_bit_rate(track):
             return bit_rate
     return 0.0
 
+def file_key(path):
+    """
+    Identify a file's contents by size and mtime.
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+PROBE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    tracks TEXT NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS probes_used ON probes (used);
+"""
+
+class ProbeResult:
+    """
+    Parsed tracks restored from the probe cache, standing in for a
+    MediaInfo object.
+    """
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+def load_track(data):
+    track = Track.__new__(Track)
+    track.__dict__.update(data)
+    return track
+
+PROBE_LOOKUPS = metrics.counter("replicant_probe_cache_lookups_total",
+        "Probe cache lookups, by result.")
+PROBE_HIT_RATIO = metrics.gauge("replicant_probe_cache_hit_ratio",
+        "Fraction of probe cache lookups served from the cache.")
+
+class ProbeCache:
+    """
+    Persistent cache of MediaInfo track data, keyed by path, size and
+    mtime, so unchanged files are not parsed again over the mount.
+    The least recently used entries are evicted beyond the size cap.
+    """
+
+    def __init__(self, config):
+        self.max_entries = config['maxEntries']
+        self.lock = Lock()
+        self.db = sqlite3.connect(config['path'], check_same_thread=False)
+        self.db.executescript(PROBE_SCHEMA)
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        PROBE_HIT_RATIO.track(self.hit_rate)
+
+    def parse(self, source):
+        """
+        Return the parsed tracks of a file, probing it on a miss.
+        """
+        (size, mtime) = file_key(source)
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT tracks FROM probes WHERE path = ? AND size = ? AND mtime = ?",
+                    (source, size, mtime)).fetchone()
+            if row:
+                self.hits += 1
+                PROBE_LOOKUPS.inc(result="hit")
+                self.db.execute("UPDATE probes SET used = ? WHERE path = ?",
+                        (time.time(), source))
+                self.db.commit()
+                return ProbeResult([load_track(t) for t in json.loads(row[0])])
+            self.misses += 1
+            PROBE_LOOKUPS.inc(result="miss")
+
+        info = MediaInfo.parse(source)
+        tracks = json.dumps([t.to_data() for t in info.tracks])
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                    (source, size, mtime, tracks, time.time()))
+            self.evict()
+            self.db.commit()
+        return info
+
+    def evict(self):
+        """
+        Drop the least recently used entries beyond the cap.
+        """
+        (count,) = self.db.execute("SELECT COUNT(*) FROM probes").fetchone()
+        if count <= self.max_entries:
+            return
+        self.db.execute(
+                "DELETE FROM probes WHERE path IN "
+                "(SELECT path FROM probes ORDER BY used LIMIT ?)",
+                (count - self.max_entries,))
+        logger.debug("Evicted %d probe cache entries", count - self.max_entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
 class VideoInfo:
     """
     Abstraction over MediaInfo, to assist in selecting tracks.
+    Results are read from the probe cache when one is given.
     """
 
-    def __init__(self, source, lang='eng'):
+    def __init__(self, source, lang='eng', cache=None):
         self.source = source
         self.lang = lang
-        self.info = MediaInfo.parse(self.source)
+        if cache:
+            self.info = cache.parse(self.source)
+        else:
+            self.info = MediaInfo.parse(self.source)
 
         # Split the tracks info the expected types
         self.generalList = [t for t in self.info.tracks if t.track_type == 'General']
@@ -0,0 +1,69 @@
+import math
+import logging
+from threading import Lock
+
+from transcoder.throughput import encodings_key
+
+logger = logging.getLogger("replicant.transcoder")
+
+
+class Workload:
+    """
+    Tracks convert jobs that are planned or scheduled but not yet
+    finished, to size splits against the scheduler's free capacity.
+    Splits reserve their expected converts when created, so plans made
+    in quick succession see each other's work.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.pending = 0
+        self.lock = Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.pending += count
+
+    def done(self, count=1):
+        with self.lock:
+            self.pending = max(0, self.pending - count)
+
+    def free_slots(self):
+        with self.lock:
+            return max(0, self.max_workers - self.pending)
+
+    def segment_count(self, duration, seg_min, seg_max, minimum=1):
+        """
+        Choose the number of segments for a source of the given duration
+        in seconds, one per free worker and at least minimum, within the
+        bounds set by the segment length limits.
+        """
+        parts = bounded(duration, seg_min, seg_max, max(minimum, self.free_slots()))
+        logger.debug("Segment count %d for %ds, %d pending converts",
+                parts, duration, self.pending)
+        return parts
+
+
+def bounded(duration, seg_min, seg_max, parts):
+    """
+    Clamp a number of segments to the segment length limits.
+    """
+    lowest = max(1, math.ceil(duration / seg_max))
+    highest = max(lowest, math.floor(duration / seg_min))
+    return min(highest, max(lowest, parts))
+
+
+def choose_parts(encodings, duration, workload=None):
+    """
+    Number of segments to convert a source into. The throughput model,
+    once trained, sets a minimum keeping each convert within its target
+    wall time.
+    """
+    enc = encodings[0]
+    minimum = 1
+    if enc.model:
+        minimum = enc.model.segment_parts(encodings_key(encodings), enc.info,
+                duration) or 1
+    if workload:
+        return workload.segment_count(duration, enc.seg_min, enc.seg_max, minimum)
+    return max(enc.segment_count(), bounded(duration, enc.seg_min, enc.seg_max, minimum))
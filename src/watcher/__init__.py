@@ -2,22 +2,54 @@ import os
 import time
 import traceback
 import logging
-import gzip
-import re
 from threading import Thread, Event
 from queue import Queue
 
+import metrics
+import tracing
 from watcher.server import run_server, stop_server
+from watcher.notify import Notifier, NotifyUnavailable
+from watcher.index import ScanIndex, Entry
+from watcher.journal import Journal
+from watcher.pathset import PathSet
+from watcher.filters import PathFilter
+from watcher.coalesce import Coalescer
 
 logger = logging.getLogger("replicant.watcher")
 
+WALK_SECONDS = metrics.summary("replicant_walk_seconds",
+        "Time spent walking directories for new files.")
+WALK_FILES = metrics.summary("replicant_walk_files",
+        "New files found by directory walks.")
+LAST_WALK = metrics.gauge("replicant_last_walk_timestamp_seconds",
+        "Completion time of the last full walk of the root directory.")
+QUEUE_DEPTH = metrics.gauge("replicant_queue_depth",
+        "Entries waiting on the watcher's queues.")
+
+
+class WakeQueue(Queue):
+    """
+    Queue that sets an event whenever an item is added, allowing a
+    single thread to block on several queues.
+    """
+
+    def __init__(self, wakeup):
+        super().__init__()
+        self.wakeup = wakeup
+
+    def _put(self, item):
+        super()._put(item)
+        self.wakeup.set()
+
 
 class Watcher(Thread):
     """
     Walk a folder structure and identify 'new' files.
+    Where supported, filesystem notifications are used to pick up files
+    as they land, with the walk kept as a periodic reconciliation.
     Files are pushed to a queue.
     Files can be marked as done via the finished queue.
-    These files are stashed to remained marked as finished across 
+    These files are journaled to remain marked as finished across
     executions.
     """
 
@@ -26,25 +58,42 @@ class Watcher(Thread):
         self.name = "replicant.watcher"
         self.exception = None
         self.shutdown_flag = Event()
+        self.wakeup = Event()
         self.server = None
+        self.routes = {'/metrics': lambda query: metrics.render()}
+        self.notifier = None
+        self.notify_thread = None
+        self.index = None
+        self.last_walk = 0
+        self.backlog = False
 
         # Args
         self.config = config
+        self.filter = PathFilter(config)
+        self.coalescer = Coalescer(config['coalesceDelay'])
 
         # Sets
-        self.seen_set = {}
-        self.finished_set = {}
+        self.seen_set = PathSet()
+        self.finished_set = PathSet()
+        self.journal = Journal(config['backupPath'], config['journalPath'],
+                config['compactSize'])
 
         # Queues
         self.new = Queue()
-        self.finished = Queue()
-        self.command_queue = Queue()
+        self.finished = WakeQueue(self.wakeup)
+        self.command_queue = WakeQueue(self.wakeup)
+        self.notifications = WakeQueue(self.wakeup)
+        QUEUE_DEPTH.track(self.new.qsize, queue="new")
+        QUEUE_DEPTH.track(self.finished.qsize, queue="finished")
+        QUEUE_DEPTH.track(self.command_queue.qsize, queue="command")
+        QUEUE_DEPTH.track(self.notifications.qsize, queue="notifications")
 
     def shutdown(self):
         """
         Shutdown the watcher.
         """
         self.shutdown_flag.set()
+        self.wakeup.set()
 
     def run(self):
         """
@@ -57,8 +106,16 @@ class Watcher(Thread):
             # Load processed files
             self.restore_finished()
 
+            # Open the scan index
+            if self.config['indexPath']:
+                self.index = ScanIndex(self.config['indexPath'])
+
             # Launch the HTTP server
-            self.server = run_server(self.config['port'], self.command_queue)
+            self.server = run_server(self.config['port'], self.command_queue,
+                    self.config['intakeSize'], self.routes)
+
+            # Subscribe to filesystem notifications
+            self.start_notifier()
 
             # Begin running
             while not self.shutdown_flag.is_set():
@@ -71,50 +128,149 @@ class Watcher(Thread):
         # Cleanup
         if self.server:
             stop_server(self.server)
+        if self.notify_thread:
+            self.notifier.interrupt()
+            self.notify_thread.join()
+        if self.notifier:
+            self.notifier.close()
+        if self.index:
+            self.index.close()
         self.collect_finished()
         self.backup_finished()
 
         logger.info("Watcher Shutdown: %s", self)
 
+    def start_notifier(self):
+        """
+        Watch the root directory for changes, falling back to periodic
+        walks if notifications are unavailable.
+        """
+        if not self.config['notify']:
+            return
+        try:
+            self.notifier = Notifier(self.config['root'], self.config['notifySettle'])
+        except NotifyUnavailable as e:
+            logger.warning("Notifications unavailable, polling instead: %s", str(e))
+            self.notifier = None
+            return
+        self.notify_thread = Thread(target=self.notify_loop, name="replicant.notify")
+        self.notify_thread.start()
+
+    def notify_loop(self):
+        """
+        Block on filesystem notifications, passing any new files and
+        directories to the watcher loop.
+        """
+        while not self.shutdown_flag.is_set():
+            (files, dirs) = self.notifier.read()
+            if files or dirs or self.notifier.overflow:
+                self.notifications.put((files, dirs))
+
+    def walk_delay(self):
+        """
+        Time between full walks of the root directory. Walks only
+        reconcile missed notifications where they are active, and poll at
+        the usual rate otherwise, such as on FUSE mounts. Walks cut short
+        by the queue limit are also resumed at the usual rate.
+        """
+        if self.notifier and not self.backlog:
+            return self.config['reconcileDelay']
+        return self.config['loopDelay']
+
     def watcher_loop(self):
         """
         Watch the root directory, collecting any new files.
-        Then delays, collecting files promoted to finished.
-        """
-        count = self.walk_directory(self.config['root'], limit=self.config['maxQueued'])
-        logger.info("Watcher finished, %d new files found", count)
-
-        start = time.time()
-        while time.time() - start < self.config['loopDelay']:
-            if not self.command_queue.empty():
-                cmd = self.command_queue.get()
-                if cmd and 'path' in cmd:
-                    reattempt = 'cmd' in cmd and cmd['cmd'] == 'reattempt'
-                    count = self.walk_directory(cmd['path'], not reattempt)
-                    logger.info("Request finished, %d new files found", count)
-            self.collect_finished()
-            time.sleep(1)
-            if self.shutdown_flag.is_set():
+        Then blocks until the next walk is due, handling commands,
+        notifications and finished files as they arrive.
+        """
+        if time.time() - self.last_walk >= self.walk_delay():
+            count = self.walk_directory(self.config['root'], limit=self.config['maxQueued'],
+                    trigger="scheduled")
+            self.last_walk = time.time()
+            LAST_WALK.set(self.last_walk)
+            self.backlog = count >= self.config['maxQueued']
+            logger.info("Watcher finished, %d new files found", count)
+
+        while not self.shutdown_flag.is_set():
+            remaining = self.last_walk + self.walk_delay() - time.time()
+            if remaining <= 0:
                 return
+            pending = self.coalescer.timeout()
+            if pending is not None:
+                remaining = min(remaining, pending)
+            self.wakeup.wait(remaining)
+            self.wakeup.clear()
+            self.collect_commands()
+            self.collect_notifications()
+            self.collect_finished()
+
+    def collect_commands(self):
+        """
+        Handle any requests received by the server.
+        Path requests are coalesced, and walked once the window closes.
+        """
+        while not self.command_queue.empty():
+            cmd = self.command_queue.get()
+            if cmd and 'path' in cmd:
+                reattempt = 'cmd' in cmd and cmd['cmd'] == 'reattempt'
+                self.coalescer.add(cmd['path'], reattempt, cmd.get('received'))
 
-    def walk_directory(self, directory, skip_finished=True, limit=-1):
+        if not self.coalescer.ready():
+            return
+        requested = len(self.coalescer.pending)
+        opened = self.coalescer.opened
+        walks = self.coalescer.take()
+        for (path, reattempt) in walks:
+            count = self.walk_directory(path, not reattempt, trigger="request",
+                    received=opened)
+            logger.info("Request finished, %d new files found", count)
+        logger.info("Coalesced %d paths into %d walks, %d walks saved in total",
+                requested, len(walks), self.coalescer.saved())
+
+    def collect_notifications(self):
+        """
+        Add any new files reported by filesystem notifications, and
+        walk directories moved into the tree.
+        """
+        count = 0
+        while not self.notifications.empty():
+            (files, dirs) = self.notifications.get()
+            for directory in dirs:
+                count += self.walk_directory(directory)
+            for source in files:
+                if not self.filter.allow_ancestors(source, self.config['root']):
+                    continue
+                if os.path.isfile(source) and self.add_file(source):
+                    count += 1
+        if count > 0:
+            logger.info("Notification finished, %d new files found", count)
+        if self.notifier and self.notifier.take_overflow():
+            self.last_walk = 0
+
+    def walk_directory(self, directory, skip_finished=True, limit=-1,
+            trigger="notification", received=None):
         """
         Walk the directory, collecting any new files.
+        A path to a single file is considered on its own.
+        Files found by a walk requested over HTTP have their traces start
+        from when the request was received.
         """
+        origin = (trigger, time.time(), received)
+        if os.path.isfile(directory):
+            return 1 if self.add_file(directory, skip_finished, origin=origin) else 0
+        count = self.walk_tree(directory, skip_finished, limit, origin)
+        WALK_SECONDS.observe(time.time() - origin[1], trigger=trigger)
+        WALK_FILES.observe(count, trigger=trigger)
+        return count
+
+    def walk_tree(self, directory, skip_finished, limit, origin):
         count = 0
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                source = os.path.join(root, filename)
-                if skip_finished and source in self.finished_set:
-                    logger.debug("Ignoring finished file: %s", filename)
-                elif source in self.seen_set:
-                    logger.debug("Ignoring seen file: %s", filename)
-                elif re.match(self.config['ignore'], filename):
-                    logger.debug("Ignoring regex match: %s", filename)
-                else:
-                    logger.debug("Adding file: %s", filename)
-                    self.new.put(source)
-                    self.seen_set[source] = True
+        cached = self.index is not None
+        for root, files in self.tree(directory):
+            for entry in files:
+                source = os.path.join(root, entry.name)
+                if self.add_file(source, skip_finished, entry.size, entry.mtime, cached,
+                        origin):
                     count += 1
             if limit > 0 and count >= limit: 
                 return count
@@ -122,31 +278,79 @@ class Watcher(Thread):
                 return count
         return count
 
+    def tree(self, directory):
+        """
+        Yield each directory beneath the given directory with the
+        entries of its files, using the scan index where available.
+        Excluded directories are pruned before being listed.
+        """
+        if self.index:
+            yield from self.index.walk(directory, self.filter.allow_dir)
+            return
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if self.filter.allow_dir(os.path.join(root, d))]
+            yield (root, [Entry(f, None, None) for f in files])
+
+    def add_file(self, source, skip_finished=True, size=None, mtime=None, cached=False,
+            origin=None):
+        """
+        Push a file to the new queue, unless it has already been seen,
+        finished or is filtered out. Returns True if the file was added.
+        A trace of the file is started from the request or walk that
+        found it, given as (trigger, walk start, request received).
+        """
+        filename = os.path.basename(source)
+        if skip_finished and source in self.finished_set:
+            logger.debug("Ignoring finished file: %s", filename)
+            return False
+        if source in self.seen_set:
+            logger.debug("Ignoring seen file: %s", filename)
+            return False
+
+        reason = self.filter.reject(source, size, mtime, cached)
+        if reason:
+            logger.debug("Ignoring filtered file (%s): %s", reason, filename)
+            return False
+
+        logger.debug("Adding file: %s", filename)
+        self.start_trace(source, origin)
+        self.new.put(source)
+        self.seen_set.add(source)
+        return True
+
+    def start_trace(self, source, origin):
+        (trigger, walked, received) = origin or ("notification", time.time(), None)
+        trace = tracing.start(source, received or walked)
+        if received:
+            trace.span("webhook", received, walked)
+        trace.span("walk", walked, trigger=trigger)
+
     def collect_finished(self):
         """
         Poll the finished files to clean up any that have finished.
+        The batch is journaled before returning.
         """
+        batch = []
         while not self.finished.empty():
             source = self.finished.get()
             logger.debug("Finished file: %s", source)
-            self.finished_set[source] = True
-            self.seen_set.pop(source)
+            self.finished_set.add(source)
+            self.seen_set.discard(source)
+            batch.append(source)
+        self.journal.append(batch)
 
     def backup_finished(self):
         """
-        Save the files to a gzipped backup.
+        Compact the journal into the gzipped backup.
         """
-        with gzip.open(self.config['backupPath'], 'wt') as f:
-            f.writelines([k + '\n' for k, v in self.finished_set.items()])
+        self.journal.close()
 
     def restore_finished(self):
         """
-        Read the gzipped backup.
+        Read the gzipped backup and any journaled files.
         """
-        if not os.path.isfile(self.config['backupPath']):
-            return
-        with gzip.open(self.config['backupPath'], 'rt') as f:
-            self.finished_set = {l.strip(): True for l in f.readlines()}
+        for source in self.journal.restore():
+            self.finished_set.add(source)
 
     def __repr__(self):
         return self.name
@@ -0,0 +1,77 @@
+import os
+import time
+
+
+class Coalescer:
+    """
+    Collects path requests over a short window, so that a burst of
+    requests for the same or nested paths results in a single walk of
+    each distinct subtree. The window opens with the first request and
+    is not extended by later ones, bounding the added latency.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.deadline = None
+        self.opened = None
+
+        # Counters
+        self.requested = 0
+        self.walks = 0
+
+    def add(self, path, reattempt=False, received=None):
+        """
+        Record a request to walk a path. Reattempts also walk finished
+        files. The window's first request sets when it was opened.
+        """
+        path = os.path.normpath(path)
+        self.pending[path] = self.pending.get(path, False) or reattempt
+        self.requested += 1
+        if self.deadline is None:
+            self.deadline = time.time() + self.window
+            self.opened = received or time.time()
+
+    def timeout(self):
+        """
+        Seconds until the window closes, or None if nothing is pending.
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def ready(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def take(self):
+        """
+        Return the (path, reattempt) walks covering the pending requests,
+        emptying the window. A path is dropped when an ancestor is walked
+        with at least the same reach.
+        """
+        walks = {}
+        for path in sorted(self.pending):
+            reattempt = self.pending[path]
+            if not self.covered(walks, path, reattempt):
+                walks[path] = reattempt
+        self.pending = {}
+        self.deadline = None
+        self.opened = None
+        self.walks += len(walks)
+        return list(walks.items())
+
+    @staticmethod
+    def covered(walks, path, reattempt):
+        parent = path
+        while True:
+            if parent in walks and (walks[parent] or not reattempt):
+                return True
+            (parent, child) = (os.path.dirname(parent), parent)
+            if parent == child:
+                return False
+
+    def saved(self):
+        """
+        Number of walks avoided so far.
+        """
+        return self.requested - len(self.pending) - self.walks
@@ -0,0 +1,123 @@
+import os
+import re
+import time
+import fnmatch
+import logging
+
+logger = logging.getLogger("replicant.watcher")
+
+# Prefix marking a rule as a regular expression rather than a glob.
+REGEX_PREFIX = 're:'
+
+
+def compile_rules(rules):
+    """
+    Compile a list of globs and regexes into a single pattern, matched
+    from the start of the name. Returns None for an empty list.
+    """
+    parts = []
+    for rule in rules:
+        if rule.startswith(REGEX_PREFIX):
+            parts.append(rule[len(REGEX_PREFIX):])
+        else:
+            parts.append(fnmatch.translate(rule))
+    if not parts:
+        return None
+    return re.compile("|".join("(?:%s)" % p for p in parts))
+
+
+class RuleSet:
+    """
+    Rules matched against a name, or against the full path for rules
+    containing a path separator.
+    """
+
+    def __init__(self, rules):
+        self.name = compile_rules([r for r in rules if not os.sep in r])
+        self.path = compile_rules([r for r in rules if os.sep in r])
+
+    def match(self, path):
+        if self.name and self.name.match(os.path.basename(path)):
+            return True
+        return bool(self.path and self.path.match(path))
+
+    def __bool__(self):
+        return bool(self.name or self.path)
+
+
+class PathFilter:
+    """
+    Decides which directories the watcher descends into and which files
+    it queues, compiled once from the watcher's filter configuration.
+
+    Rules are globs, or regexes when prefixed with 're:'. The legacy
+    'ignore' regex is treated as an exclude rule.
+    """
+
+    def __init__(self, config):
+        filters = config['filters']
+        exclude = list(filters['exclude'])
+        if config.get('ignore'):
+            exclude.append(REGEX_PREFIX + config['ignore'])
+
+        self.include = RuleSet(filters['include'])
+        self.exclude = RuleSet(exclude)
+        self.exclude_dirs = RuleSet(filters['excludeDirs'])
+        self.extensions = set(e.lower().lstrip('.') for e in filters['extensions'])
+        self.min_size = filters['minSize']
+        self.min_age = filters['minAge']
+
+    def allow_dir(self, path):
+        """
+        Returns False if the directory should not be descended into.
+        """
+        return not self.exclude_dirs.match(path)
+
+    def allow_ancestors(self, path, root):
+        """
+        Returns False if any directory between the root and the path is
+        excluded.
+        """
+        directory = os.path.dirname(path)
+        while len(directory) > len(root) and directory.startswith(root):
+            if not self.allow_dir(directory):
+                return False
+            directory = os.path.dirname(directory)
+        return True
+
+    def reject(self, path, size=None, mtime=None, cached=False):
+        """
+        Returns the reason a file is filtered out, or None if it should
+        be queued. Size and mtime (in nanoseconds) are stated when needed
+        and not given. Cached values that fail the size or age checks
+        are confirmed against the file, as it may still be growing.
+        """
+        name = os.path.basename(path)
+        if self.extensions:
+            ext = os.path.splitext(name)[1].lower().lstrip('.')
+            if not ext in self.extensions:
+                return "extension"
+        if self.include and not self.include.match(path):
+            return "not included"
+        if self.exclude.match(path):
+            return "excluded"
+        if not self.min_size and not self.min_age:
+            return None
+
+        reason = self.reject_stat(path, size, mtime)
+        if reason and cached:
+            reason = self.reject_stat(path)
+        return reason
+
+    def reject_stat(self, path, size=None, mtime=None):
+        if size is None or mtime is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return "missing"
+            (size, mtime) = (st.st_size, st.st_mtime_ns)
+        if size < self.min_size:
+            return "too small"
+        if time.time() - mtime / 1e9 < self.min_age:
+            return "too new"
+        return None
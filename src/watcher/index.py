@@ -0,0 +1,182 @@
+import os
+import time
+import sqlite3
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger("replicant.watcher")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    PRIMARY KEY (dir, name)
+);
+"""
+
+# Directories modified this recently may still change within the
+# filesystem's timestamp resolution, so their listing is not trusted.
+RACY_NS = 2 * 10**9
+
+# Number of changed directories between commits.
+COMMIT_INTERVAL = 500
+
+Entry = namedtuple('Entry', ['name', 'size', 'mtime'])
+
+
+class ScanIndex:
+    """
+    On-disk record of the directory tree, used to avoid listing and
+    stating directories that have not changed since the last walk.
+    Each directory's mtime is stored along with the size and mtime of
+    the files it contains. Directories whose mtime matches the index
+    are replayed from the index, and only their subdirectories are
+    stated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.dirty = 0
+
+        # Statistics for the last walk
+        self.listed = 0
+        self.skipped = 0
+
+    def walk(self, directory, allow_dir=None):
+        """
+        Walk a directory tree, yielding a directory path and list of
+        file entries for each directory found. Subdirectories rejected
+        by allow_dir are not descended into.
+        """
+        self.listed = 0
+        self.skipped = 0
+        stack = [directory]
+        try:
+            while stack:
+                root = stack.pop()
+                listing = self.listing(root)
+                if listing is None:
+                    continue
+                (dirs, files) = listing
+                dirs = [os.path.join(root, d) for d in reversed(dirs)]
+                if allow_dir:
+                    dirs = [d for d in dirs if allow_dir(d)]
+                stack.extend(dirs)
+                yield (root, files)
+        finally:
+            self.commit()
+            logger.debug("Index walk of %s: %d listed, %d unchanged",
+                    directory, self.listed, self.skipped)
+
+    def listing(self, root):
+        """
+        Return the subdirectory names and file entries for a directory,
+        from the index if it is unchanged, otherwise from disk.
+        Returns None if the directory no longer exists.
+        """
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            self.forget(root)
+            return None
+
+        row = self.db.execute("SELECT mtime FROM dirs WHERE path = ?",
+                (root,)).fetchone()
+        if row and row[0] == mtime:
+            self.skipped += 1
+            return self.indexed(root)
+
+        self.listed += 1
+        return self.scan(root, mtime)
+
+    def indexed(self, root):
+        """
+        Replay a directory listing from the index.
+        """
+        dirs = []
+        files = []
+        rows = self.db.execute(
+                "SELECT name, is_dir, size, mtime FROM entries WHERE dir = ? ORDER BY name",
+                (root,))
+        for (name, is_dir, size, mtime) in rows:
+            if is_dir:
+                dirs.append(name)
+            else:
+                files.append(Entry(name, size, mtime))
+        return (dirs, files)
+
+    def scan(self, root, mtime):
+        """
+        List a directory from disk, recording the result in the index.
+        """
+        dirs = []
+        files = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files.append(Entry(entry.name, st.st_size, st.st_mtime_ns))
+                    except OSError as e:
+                        logger.debug("Failed to stat %s: %s", entry.path, str(e))
+        except OSError as e:
+            logger.warning("Failed to list %s: %s", root, str(e))
+            return None
+        dirs.sort()
+        files.sort()
+
+        # Drop subtrees that have disappeared
+        known = self.db.execute(
+                "SELECT name FROM entries WHERE dir = ? AND is_dir = 1", (root,))
+        for (name,) in known.fetchall():
+            if not name in dirs:
+                self.forget(os.path.join(root, name))
+
+        # Record the new listing
+        if time.time_ns() - mtime < RACY_NS:
+            mtime = None
+        self.db.execute("DELETE FROM entries WHERE dir = ?", (root,))
+        self.db.executemany("INSERT INTO entries VALUES (?, ?, 1, NULL, NULL)",
+                [(root, d) for d in dirs])
+        self.db.executemany("INSERT INTO entries VALUES (?, ?, 0, ?, ?)",
+                [(root, f.name, f.size, f.mtime) for f in files])
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (root, mtime))
+        self.mark_dirty()
+        return (dirs, files)
+
+    def forget(self, root):
+        """
+        Remove a directory and everything beneath it from the index.
+        """
+        prefix = os.path.join(root, '')
+        for (table, column) in [('dirs', 'path'), ('entries', 'dir')]:
+            self.db.execute(
+                    "DELETE FROM %s WHERE %s = ? OR substr(%s, 1, ?) = ?" %
+                    (table, column, column), (root, len(prefix), prefix))
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self.dirty += 1
+        if self.dirty >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        if self.dirty > 0:
+            self.db.commit()
+            self.dirty = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,149 @@
+import os
+import gzip
+import logging
+from threading import Thread, Lock
+
+logger = logging.getLogger("replicant.watcher")
+
+
+def read_lines(f):
+    """
+    Yield complete lines from a file, dropping a trailing partial line
+    left by an interrupted write.
+    """
+    for line in f:
+        if line.endswith('\n'):
+            yield line[:-1]
+
+
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    Append-only journal of finished paths, backed by a gzipped snapshot.
+    Each batch of appends is flushed and synced once. When the journal
+    grows past the compaction size it is rotated aside and merged into
+    the snapshot on a background thread.
+    """
+
+    def __init__(self, snapshot, path, compact_size):
+        self.snapshot = snapshot
+        self.path = path
+        self.rotated = path + '.old'
+        self.compact_size = compact_size
+        self.lock = Lock()
+        self.compactor = None
+        self.entries = 0
+        self.file = None
+
+    def restore(self):
+        """
+        Yield every finished path from the snapshot and journals, then
+        open the journal for appending.
+        """
+        if os.path.isfile(self.snapshot):
+            with gzip.open(self.snapshot, 'rt') as f:
+                for line in read_lines(f):
+                    yield line
+        for path in [self.rotated, self.path]:
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r') as f:
+                for line in read_lines(f):
+                    self.entries += 1
+                    yield line
+        self.open()
+
+    def open(self):
+        """
+        Open the journal, discarding any partial line.
+        """
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb+') as f:
+                data = f.read()
+                if data and not data.endswith(b'\n'):
+                    f.truncate(data.rfind(b'\n') + 1)
+        self.file = open(self.path, 'a')
+
+    def append(self, paths):
+        """
+        Durably record a batch of finished paths.
+        """
+        if not paths or not self.file:
+            return
+        with self.lock:
+            self.file.writelines([p + '\n' for p in paths])
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries += len(paths)
+            compact = self.entries >= self.compact_size
+        if compact:
+            self.compact(background=True)
+
+    def compact(self, background=False):
+        """
+        Merge the journal into the snapshot.
+        """
+        if self.compactor and self.compactor.is_alive():
+            if not background:
+                self.compactor.join()
+            else:
+                return
+
+        with self.lock:
+            # A rotated journal left by an interrupted compaction is
+            # merged first, leaving the live journal in place.
+            if not os.path.isfile(self.rotated):
+                self.file.close()
+                os.replace(self.path, self.rotated)
+                self.file = open(self.path, 'a')
+                self.entries = 0
+
+        if background:
+            self.compactor = Thread(target=self.merge, name="replicant.journal")
+            self.compactor.start()
+        else:
+            self.merge()
+
+    def merge(self):
+        """
+        Write a new snapshot from the old snapshot and rotated journal,
+        replacing it atomically before discarding the rotated journal.
+        """
+        try:
+            paths = set()
+            if os.path.isfile(self.snapshot):
+                with gzip.open(self.snapshot, 'rt') as f:
+                    paths.update(read_lines(f))
+            with open(self.rotated, 'r') as f:
+                paths.update(read_lines(f))
+
+            tmp = self.snapshot + '.tmp'
+            with open(tmp, 'wb') as raw:
+                with gzip.open(raw, 'wt') as f:
+                    f.writelines([p + '\n' for p in paths])
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp, self.snapshot)
+            fsync_dir(self.snapshot)
+            os.remove(self.rotated)
+            logger.debug("Compacted finished journal, %d entries", len(paths))
+        except Exception as e:
+            logger.error("Failed to compact finished journal: %s", str(e))
+
+    def close(self):
+        """
+        Compact the journal and release it.
+        """
+        if not self.file:
+            return
+        self.compact()
+        with self.lock:
+            self.file.close()
+            self.file = None
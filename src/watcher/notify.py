@@ -0,0 +1,252 @@
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger("replicant.watcher")
+
+# Flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+
+class NotifyUnavailable(Exception):
+    pass
+
+
+def load_libc():
+    """
+    Load the C library, ensuring it provides the inotify calls.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError) as e:
+        raise NotifyUnavailable("inotify is not supported: %s" % str(e))
+    return libc
+
+
+def mount_type(path):
+    """
+    Filesystem type of the mount holding a path, or None if unknown.
+    """
+    path = os.path.realpath(path)
+    (best, kind) = ("", None)
+    try:
+        with open('/proc/self/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1].replace('\\040', ' ')
+                inside = path == point or path.startswith(point.rstrip('/') + '/')
+                if inside and len(point) > len(best):
+                    (best, kind) = (point, fields[2])
+    except OSError:
+        return None
+    return kind
+
+
+class Notifier:
+    """
+    Recursive inotify watch over a directory tree.
+    Directories are registered as they appear, and files are reported
+    once they have been fully written or moved into the tree. Files
+    that are created without being written (such as hardlinks) are
+    reported after the settle delay.
+    FUSE mounts, such as rclone's, are refused, as changes made on the
+    remote side produce no events.
+    """
+
+    def __init__(self, root, settle=10):
+        self.root = root
+        self.settle = settle
+        kind = mount_type(root)
+        if kind and kind.startswith('fuse'):
+            raise NotifyUnavailable("%s is on a %s mount" % (root, kind))
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise NotifyUnavailable(os.strerror(ctypes.get_errno()))
+
+        # State
+        self.watches = {}
+        self.pending = {}
+        self.overflow = False
+
+        # Pipe used to interrupt a blocking read
+        (self.wake_r, self.wake_w) = os.pipe()
+
+        self.add_tree(root)
+
+    def add_watch(self, path):
+        """
+        Register a single directory, returning False if it could not be
+        watched.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise NotifyUnavailable("inotify watch limit reached")
+            logger.debug("Failed to watch %s: %s", path, os.strerror(err))
+            return False
+        self.watches[wd] = path
+        return True
+
+    def add_tree(self, directory, settle=False):
+        """
+        Register a directory and all its subdirectories. With settle, the
+        files found are held as pending, as they may still be written.
+        """
+        count = 0
+        now = time.time()
+        for root, dirs, files in os.walk(directory):
+            if self.add_watch(root):
+                count += 1
+            if settle:
+                for name in files:
+                    self.pending.setdefault(os.path.join(root, name), now)
+        logger.debug("Watching %d directories under %s", count, directory)
+
+    def remove_tree(self, directory):
+        """
+        Forget the watches of a directory and its subdirectories, along
+        with any files pending beneath it.
+        """
+        prefix = directory.rstrip('/') + '/'
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.remove_watch(wd)
+        for path in list(self.pending):
+            if path.startswith(prefix):
+                del self.pending[path]
+
+    def remove_watch(self, wd):
+        """
+        Forget a watch, removing it from the kernel if still present.
+        """
+        if self.watches.pop(wd, None) is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait for events, for at most timeout seconds if given, or until
+        the next pending file settles, or until interrupted.
+        Returns a tuple of the new files and new directories.
+        """
+        files = []
+        dirs = []
+        if self.pending:
+            settle = min(self.pending.values()) + self.settle - time.time()
+            timeout = max(0, settle if timeout is None else min(timeout, settle))
+        ready, _, _ = select.select([self.fd, self.wake_r], [], [], timeout)
+        if self.wake_r in ready:
+            os.read(self.wake_r, 64)
+        if self.fd in ready:
+            self.read_events(files, dirs)
+        self.expire_pending(files)
+        return (files, dirs)
+
+    def interrupt(self):
+        """
+        Wake a thread blocked in read.
+        """
+        os.write(self.wake_w, b'\0')
+
+    def read_events(self, files, dirs):
+        """
+        Drain the inotify descriptor, sorting events into files and
+        directories.
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Notification queue overflowed")
+                self.overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.remove_watch(wd)
+                continue
+            if not wd in self.watches:
+                continue
+
+            # A renamed directory keeps its watches, so those beneath the
+            # old path are dropped and the tree watched again at the new.
+            # Moved in directories are complete and reported at once, while
+            # files in created ones are left to settle.
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.remove_tree(path)
+                if mask & IN_MOVED_TO:
+                    self.add_tree(path)
+                    dirs.append(path)
+                elif mask & IN_CREATE:
+                    self.add_tree(path, settle=True)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.pending.pop(path, None)
+                files.append(path)
+            elif mask & (IN_CREATE | IN_MODIFY):
+                self.pending[path] = time.time()
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.pending.pop(path, None)
+
+    def expire_pending(self, files):
+        """
+        Report created files that have not been modified recently.
+        """
+        now = time.time()
+        for path, last in list(self.pending.items()):
+            if now - last >= self.settle:
+                del self.pending[path]
+                files.append(path)
+
+    def take_overflow(self):
+        """
+        Returns True once after events have been dropped by the kernel.
+        """
+        overflow = self.overflow
+        self.overflow = False
+        return overflow
+
+    def close(self):
+        for fd in [self.fd, self.wake_r, self.wake_w]:
+            os.close(fd)
+        self.watches = {}
@@ -0,0 +1,87 @@
+import os
+import sys
+
+# Separator between packed names, which cannot appear in a path.
+SEP = '\0'
+
+# Directories holding more names than this are kept as a set, so adds
+# do not copy an ever growing string.
+PACKED_MAX = 256
+
+
+class PathSet:
+    """
+    Set of file paths, grouped by directory.
+    Each directory string is interned and stored once. The names within
+    a directory are packed into a single separator delimited string,
+    avoiding a string object and hash table slot per file, so libraries
+    with long shared prefixes cost little more than the names
+    themselves. Large directories fall back to a set of names.
+    """
+
+    def __init__(self, paths=()):
+        self.dirs = {}
+        self.count = 0
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        (directory, name) = os.path.split(path)
+        names = self.dirs.get(directory)
+        if names is None:
+            self.dirs[sys.intern(directory)] = SEP + name + SEP
+        elif isinstance(names, set):
+            if name in names:
+                return
+            names.add(name)
+        else:
+            if SEP + name + SEP in names:
+                return
+            names += name + SEP
+            if names.count(SEP) > PACKED_MAX:
+                names = set(names.split(SEP)[1:-1])
+            self.dirs[directory] = names
+        self.count += 1
+
+    def discard(self, path):
+        (directory, name) = os.path.split(path)
+        names = self.dirs.get(directory)
+        if names is None or not self.contains(names, name):
+            return
+        if isinstance(names, set):
+            names.remove(name)
+        else:
+            names = names.replace(SEP + name + SEP, SEP, 1)
+            self.dirs[directory] = names
+        self.count -= 1
+        if not names or names == SEP:
+            del self.dirs[directory]
+
+    def remove(self, path):
+        if not path in self:
+            raise KeyError(path)
+        self.discard(path)
+
+    @staticmethod
+    def contains(names, name):
+        if isinstance(names, set):
+            return name in names
+        return SEP + name + SEP in names
+
+    def __contains__(self, path):
+        (directory, name) = os.path.split(path)
+        names = self.dirs.get(directory)
+        return names is not None and self.contains(names, name)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for directory, names in self.dirs.items():
+            if not isinstance(names, set):
+                names = names.split(SEP)[1:-1]
+            for name in names:
+                yield os.path.join(directory, name)
+
+    def __repr__(self):
+        return "PathSet(%d paths in %d directories)" % (self.count, len(self.dirs))
@@ -1,11 +1,17 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
 from threading import Thread
+from queue import Queue, Full
 import logging
+import time
 import json
 import os
 
 logger = logging.getLogger("replicant.watcher")
 
+# Largest request body accepted, in bytes.
+MAX_BODY = 1024 * 1024
+
 
 def sonarr_extract(j):
     """
@@ -28,34 +34,135 @@ def radarr_extract(j):
     path = j['movieFile']['path']
     return { 'path': path }
 
-def run_server(port, queue):
-    class Server(BaseHTTPRequestHandler):
-        def _set_response(self):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-    
-        def do_GET(self):
-            self._set_response()
-    
-        def do_POST(self):
+def parse_request(body):
+    """
+    Convert a request body into a command, routing sonarr and radarr
+    webhooks through their extractors. Returns None if there is
+    nothing to do.
+    """
+    j = json.loads(body)
+    if not isinstance(j, dict):
+        return None
+    if 'series' in j:
+        return sonarr_extract(j)
+    if 'movie' in j or 'movieFile' in j:
+        return radarr_extract(j)
+    return j
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Acknowledges requests once they are on the intake queue, leaving
+    parsing to the server's parser thread.
+    GET requests to a registered route are answered with its JSON result,
+    or as plain text where the route returns a string.
+    """
+
+    def _set_response(self, code):
+        self.send_response(code)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_result(self, result):
+        if isinstance(result, str):
+            (body, kind) = (result, 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            (body, kind) = (json.dumps(result), 'application/json')
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if not route:
+            self._set_response(200)
+            return
+        try:
+            result = route(dict(parse_qsl(url.query)))
+        except ValueError as e:
+            logger.warning("Bad query %s: %s", self.path, str(e))
+            self._set_response(400)
+            return
+        except Exception as e:
+            logger.error("Query failure %s: %s", self.path, str(e))
+            self._set_response(500)
+            return
+        self._send_result(result)
+
+    def do_POST(self):
+        try:
             content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            logger.info("Post: %s", post_data)
+        except (TypeError, ValueError):
+            self._set_response(411)
+            return
+        if content_length > MAX_BODY:
+            self._set_response(413)
+            return
+
+        post_data = self.rfile.read(content_length)
+        logger.debug("Post: %s", post_data)
+        try:
+            self.server.intake.put_nowait((time.time(), post_data))
+        except Full:
+            logger.warning("Intake queue full, rejecting request")
+            self._set_response(429)
+            return
+        self._set_response(202)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP server handling each request on its own thread.
+    Accepted bodies are placed on a bounded intake queue and parsed
+    into commands by a single parser thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, port, queue, intake_size, routes=None):
+        super().__init__(('', port), Handler)
+        self.commands = queue
+        self.routes = routes or {}
+        self.intake = Queue(maxsize=intake_size)
+        self.parser = Thread(target=self.parse_loop, name="replicant.parser",
+                daemon=True)
+
+    def parse_loop(self):
+        """
+        Parse intake bodies until a None entry is received.
+        Commands are stamped with the time their request was received.
+        """
+        while True:
+            entry = self.intake.get()
+            if entry is None:
+                return
+            (received, body) = entry
             try:
-                j = json.loads(post_data)
-                sonarr = sonarr_extract(j)
-                if sonarr:
-                    queue.put(sonarr)
-                else:
-                    queue.put(j)
-            except:
-                logging.error("Bad request")
-            self._set_response()
-
-    httpd = HTTPServer(('', port), Server)
-    Thread(target=httpd.serve_forever).start()
+                cmd = parse_request(body)
+            except Exception as e:
+                logger.error("Bad request: %s", str(e))
+                continue
+            if cmd:
+                logger.info("Request: %s", cmd)
+                cmd['received'] = received
+                self.commands.put(cmd)
+
+def run_server(port, queue, intake_size=100, routes=None):
+    httpd = WebhookServer(port, queue, intake_size, routes)
+    httpd.parser.start()
+    Thread(target=httpd.serve_forever, name="replicant.server").start()
     return httpd
 
 def stop_server(server):
-    Thread(target=server.shutdown, daemon=True).start()
+    def stop():
+        server.shutdown()
+        server.server_close()
+        server.intake.put(None)
+    Thread(target=stop, daemon=True).start()